@@ -0,0 +1,197 @@
+# gone/bench.py
+'''
+Interpreter Benchmark
+=====================
+Measures how fast the interpreter in gone/interp.py dispatches
+instructions.  For each program, the number of executed instructions
+is counted once and every engine is then timed running __init() and
+main().  Output produced by the program is discarded.
+
+To run a benchmark use::
+
+    bash % python3 -m gone.bench Programs/mandel.g Programs/fib.g
+
+The 'lookup' engine reproduces the original dispatch loop which finds
+the run_opcode() method by name on every instruction.  It is kept as
+the baseline the other engines are compared against.  The instruction
+rate of engines that do not dispatch IR instructions ('python') is
+given in IR instructions per second for comparison.  The 'fused'
+engine runs the code after BlockLinker's superinstruction pass, so it
+dispatches fewer instructions than it executes IR instructions.
+'''
+
+import io
+import os
+import sys
+import time
+from contextlib import redirect_stdout
+
+from . import interp
+
+
+class LookupInterpreter(interp.Interpreter):
+    '''
+    Interpreter that looks up the run_opcode() method of every
+    instruction as it executes.
+    '''
+
+    def register_functions(self, functionlist):
+        self.functions = {}
+        for func, code, nslots in functionlist:
+            self.functions[func.name] = interp.DecodedFunction(
+                func.name, code + [('return_void',)], nslots)
+
+    def run(self, depth):
+        while True:
+            instr = self.code[self.pc]
+            opcode = instr[0]
+            self.pc += 1
+            if hasattr(self, "run_" + opcode):
+                if getattr(self, "run_" + opcode)(*instr[1:]):
+                    if len(self.framestack) == depth:
+                        break
+            else:
+                print("Warning: No run_" + opcode + "() method")
+
+
+class CountingInterpreter(interp.Interpreter):
+    '''
+    Interpreter that counts the number of instructions executed.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(CountingInterpreter, self).__init__(*args, **kwargs)
+        self.count = 0
+
+    def run(self, depth):
+        code = self.code
+        while True:
+            handler, operands = code[self.pc]
+            self.pc += 1
+            self.count += 1
+            if handler(*operands):
+                if len(self.framestack) == depth:
+                    break
+                code = self.code
+
+
+def linked(cls, fuse=True):
+    '''
+    Return a function that loads a list of ircode.Function objects into
+    a new instance of an Interpreter class.  Output of the program is
+    captured in memory.
+    '''
+    def create(functions):
+        interpreter = cls(output=interp.Output(capture=True))
+        interpreter.register_functions(
+            interp.link_functions(functions, fuse))
+        return interpreter
+    create.fuse = fuse
+    return create
+
+
+def translated(functions):
+    return interp.create_interpreter(functions, 'python',
+                                     output=interp.Output(capture=True))
+
+
+# Engines to compare, in the order they are reported.  Each one creates
+# a ready to run interpreter from a list of ircode.Function objects.
+engines = {
+    'lookup': linked(LookupInterpreter, fuse=False),
+    'decoded': linked(interp.Interpreter, fuse=False),
+    'fused': linked(interp.Interpreter),
+    'python': translated,
+}
+
+
+def run_program(create, functions):
+    '''
+    Run __init() and main() of a program in a new interpreter made by
+    the engine function create.  Only the execution is timed.  Returns
+    the interpreter and the elapsed time.
+    '''
+    interpreter = create(functions)
+    start = time.perf_counter()
+    interpreter.execute_function('__init', [])
+    interpreter.execute_function('main', [])
+    return interpreter, time.perf_counter() - start
+
+
+def time_program(create, functions, repeat=3):
+    '''
+    Return the best wall clock time of several runs of a program.
+    '''
+    best = None
+    for n in range(repeat):
+        interpreter, elapsed = run_program(create, functions)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def count_dispatches(functions, fuse):
+    '''
+    Return the number of instructions dispatched running a program
+    '''
+    interpreter, elapsed = run_program(linked(CountingInterpreter, fuse),
+                                       functions)
+    return interpreter.count
+
+
+def benchmark(filename, names=None, repeat=3):
+    '''
+    Benchmark the program in filename on each named engine.  Returns a
+    list of (engine, instructions, dispatches, seconds) tuples where
+    instructions is the number of IR instructions executed and
+    dispatches the number the engine actually dispatched (None if it
+    does not dispatch instructions).
+    '''
+    from .ircode import compile_ircode
+    from .errors import errors_reported
+
+    with redirect_stdout(io.StringIO()):
+        functions = compile_ircode(open(filename).read())
+    if errors_reported():
+        raise SystemExit(1)
+    count = count_dispatches(functions, fuse=False)
+
+    results = []
+    for name in (names or engines):
+        create = engines[name]
+        if hasattr(create, 'fuse'):
+            dispatches = count_dispatches(functions, create.fuse)
+        else:
+            dispatches = None
+        seconds = time_program(create, functions, repeat)
+        results.append((name, count, dispatches, seconds))
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='python3 -m gone.bench')
+    parser.add_argument('filenames', nargs='+', metavar='filename')
+    parser.add_argument('-e', '--engine', action='append',
+                        choices=list(engines),
+                        help='engine to time (default: all)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of timed runs per engine')
+    opts = parser.parse_args()
+
+    print("%-20s %-10s %12s %12s %10s %14s %8s" % (
+        'program', 'engine', 'instructions', 'dispatches', 'seconds',
+        'instr/sec', 'speedup'))
+    for filename in opts.filenames:
+        results = benchmark(filename, opts.engine, opts.repeat)
+        baseline = results[0][3]
+        for name, count, dispatches, seconds in results:
+            print("%-20s %-10s %12d %12s %10.3f %14.0f %7.2fx" % (
+                os.path.basename(filename), name, count,
+                '-' if dispatches is None else dispatches, seconds,
+                count / seconds, baseline / seconds))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
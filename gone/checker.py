@@ -86,11 +86,50 @@ For walking the AST, use the NodeVisitor class defined in gone/ast.py.
 A shell of the code is provided below.
 '''
 
+import operator
+
 from .errors import error
 from .ast import *
 from . import types
 
 
+def constant_divide(x, y):
+    '''
+    Divide constants.  Integer division rounds down in the interpreter
+    but towards zero in LLVM code (sdiv), so a division with a negative
+    operand is left for runtime, where each backend does its own.
+    '''
+    if isinstance(x, int):
+        if x < 0 or y < 0:
+            return None
+        return x // y
+    return x / y
+
+
+# Functions evaluating the operators of constant expressions at compile
+# time.  They return None for a value that is only computed at runtime.
+constant_binary_ops = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': constant_divide,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '&&': lambda x, y: x and y,
+    '||': lambda x, y: x or y,
+}
+
+constant_unary_ops = {
+    '+': operator.pos,
+    '-': operator.neg,
+    '!': operator.not_,
+}
+
+
 class SymbolTable(object):
     """
     Class representing a symbol table.  It should provide functionality
@@ -265,9 +304,36 @@ class CheckProgramVisitor(NodeVisitor):
         else:
             self.visit(node.expr)
             node.type = node.expr.type
-            # 2. Add an entry to the symbol table
+            # 2. Evaluate the value if it is known at compile time
+            node.value = self.constant_value(node.expr)
+            # 3. Add an entry to the symbol table
             self.symtab_add(node.name, node)
 
+    def constant_value(self, node):
+        '''
+        Return the value of an expression of literals, constants and
+        operators, or None if it can only be computed at runtime
+        '''
+        if isinstance(node, Literal):
+            return node.value
+        elif isinstance(node, LoadVariable):
+            if isinstance(node.symbol, ConstantDeclaration):
+                return node.symbol.value
+        elif isinstance(node, UnaryOperator):
+            value = self.constant_value(node.expr)
+            if value is not None and node.op in constant_unary_ops:
+                return constant_unary_ops[node.op](value)
+        elif isinstance(node, (BinaryOperator, BooleanOperator)):
+            left = self.constant_value(node.left)
+            right = self.constant_value(node.right)
+            if (left is not None and right is not None and
+                    node.op in constant_binary_ops):
+                try:
+                    return constant_binary_ops[node.op](left, right)
+                except (TypeError, ZeroDivisionError):
+                    pass
+        return None
+
     def visit_VariableDeclaration(self, node):
         # print('%s: VariableDeclaration: %s' % (node.lineno, node.__dict__))
         # 1. Check that the variable name is not already defined
@@ -2,40 +2,171 @@
 #
 # Project 5:
 # ----------
-# Compiles Gone code to a standalone executable using Clang.  This
-# requires the clang compiler to be installed on your machine.  You
-# might have to fiddle with some of the path settings and other details
-# to make this work.
+# Compiles Gone code to a standalone executable.  The object file of
+# the program is generated in process by LLVM and linked with the Gone
+# runtime (gonert.c) by the C compiler (clang, or $CC if set).  The
+# runtime is compiled once and its object file is kept in the cache
+# directory of gone/run.py (under runtime/), so a build only runs the
+# final link.
 #
 # Note: A minor change is required in Project 8.  See note in the code.
 
+import hashlib
+import os
+import os.path
+import shutil
 import subprocess
 import sys
-import os.path
 import tempfile
 
-from .llvmgen import compile_llvm
+from .llvmgen import compile_module, optimize, timed
+from .llvmgen import fastmath_flags, fastmath_names
+from .llvmgen import generate_functions, map_partitions, parse_module
 from .errors import errors_reported
+from .run import create_target_machine, default_cache_dir
 
 # Name of the runtime library
 _rtlib = os.path.join(os.path.dirname(__file__), 'gonert.c')
 
 
+def c_compiler():
+    '''
+    Return the C compiler used to compile the runtime and link
+    '''
+    if 'CC' in os.environ:
+        return os.environ['CC']
+    return 'clang' if shutil.which('clang') else 'cc'
+
+
+def emit_object(module, opt_level=0, target_machine=None):
+    '''
+    Optimize a llvmlite.binding module at opt_level and return the
+    machine code of an object file for it
+    '''
+    # Executables are position independent by default on most systems
+    target_machine = target_machine or create_target_machine(opt_level,
+                                                             reloc='pic')
+    module.triple = target_machine.triple
+    module.data_layout = str(target_machine.target_data)
+    optimize(module, opt_level, target_machine)
+    return target_machine.emit_object(module)
+
+
+def partition_object(functions, symbols, opt_level=0, ssa=False,
+                     fastmath=(), host_cpu=False):
+    '''
+    Return the object code of a partition of a program (see
+    llvmgen.map_partitions()).  Run in the worker processes of
+    compile_executable().
+    '''
+    module = parse_module(generate_functions(functions, ssa,
+                                             fastmath=fastmath,
+                                             symbols=symbols))
+    return emit_object(module, opt_level,
+                       create_target_machine(opt_level, host_cpu, 'pic'))
+
+
+def runtime_object(cc=None, cache_dir=None):
+    '''
+    Return the name of the object file of the runtime (with main()),
+    compiling it first if it is not in the cache directory yet
+    '''
+    cc = cc or c_compiler()
+    cache_dir = os.path.join(cache_dir or default_cache_dir, 'runtime')
+    with open(_rtlib, 'rb') as f:
+        digest = hashlib.sha256(f.read() + cc.encode('utf-8')).hexdigest()
+    filename = os.path.join(cache_dir, 'gonert-%s.o' % digest[:16])
+    if not os.path.exists(filename):
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=cache_dir, suffix='.o')
+        os.close(fd)
+        try:
+            subprocess.check_output([cc, '-DNEED_MAIN', '-O2', '-fPIC', '-c',
+                                     _rtlib, '-o', tmpname])
+            os.replace(tmpname, filename)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+    return filename
+
+
+def compile_executable(source, output='a.out', opt_level=0, ssa=False,
+                       cc=None, cache_dir=None, timings=None, host_cpu=False,
+                       fastmath=(), jobs=1):
+    '''
+    Compile Gone source to an executable.  Returns False if the program
+    has errors.  With host_cpu the code is generated for the host CPU
+    and fastmath are the fast-math flags of the float instructions.
+    With more than one job, the functions are split into partitions
+    that are compiled to separate object files in parallel.
+    '''
+    from .ircode import compile_ircode
+
+    cc = cc or c_compiler()
+    if jobs > 1:
+        with timed(timings, 'ircode'):
+            functions = compile_ircode(source)
+        if errors_reported():
+            return False
+        with timed(timings, 'codegen'):
+            objs = map_partitions(partition_object, functions, jobs,
+                                  opt_level, ssa, fastmath, host_cpu)
+    else:
+        module = compile_module(source, ssa=ssa, timings=timings,
+                                fastmath=fastmath)
+        if errors_reported():
+            return False
+        with timed(timings, 'codegen'):
+            # With host_cpu the executable only runs on machines with
+            # the host's CPU features
+            objs = [emit_object(module, opt_level, create_target_machine(
+                opt_level, host_cpu, 'pic'))]
+    with timed(timings, 'runtime'):
+        rtobj = runtime_object(cc, cache_dir)
+    with timed(timings, 'link'):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filenames = []
+            for n, obj in enumerate(objs):
+                filenames.append(os.path.join(tmpdir, 'gone%d.o' % n))
+                with open(filenames[-1], 'wb') as f:
+                    f.write(obj)
+            subprocess.check_output([cc] + filenames + [rtobj, '-o', output])
+    return True
+
+
 def main():
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: python3 -m gone.compile filename\n")
-        raise SystemExit(1)
+    import argparse
 
-    source = open(sys.argv[1]).read()
-    llvm_code = compile_llvm(source)
-    if not errors_reported():
-        with tempfile.NamedTemporaryFile(suffix='.ll') as f:
-            f.write(llvm_code.encode('utf-8'))
-            f.flush()
-            # subprocess.check_output(['clang',  f.name, _rtlib, '-lm'])
+    parser = argparse.ArgumentParser(prog='python3 -m gone.compile')
+    parser.add_argument('filename')
+    parser.add_argument('-o', dest='output', default='a.out',
+                        help='name of the executable (default: a.out)')
+    parser.add_argument('-O', dest='opt_level', type=int, default=0,
+                        choices=range(4), help='optimization level')
+    parser.add_argument('--ssa', action='store_true',
+                        help='keep local variables in registers')
+    parser.add_argument('--host-cpu', action='store_true',
+                        help='generate code for the CPU of this machine')
+    parser.add_argument('--fast-math', dest='fastmath', type=fastmath_flags,
+                        default=(), metavar='FLAGS',
+                        help='comma separated fast-math flags of float '
+                        'instructions (%s)' % ', '.join(fastmath_names))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='compile the functions to this many object '
+                        'files in parallel (default: 1)')
+    parser.add_argument('--timings', action='store_true',
+                        help='print the time taken by each phase')
+    opts = parser.parse_args()
 
-            # Use this version when you get to Project 8
-            subprocess.check_output(['clang', '-DNEED_MAIN', f.name, _rtlib])
+    timings = {}
+    source = open(opts.filename).read()
+    if not compile_executable(source, opts.output, opts.opt_level, opts.ssa,
+                              timings=timings, host_cpu=opts.host_cpu,
+                              fastmath=opts.fastmath, jobs=opts.jobs):
+        raise SystemExit(1)
+    if opts.timings:
+        for phase, seconds in timings.items():
+            sys.stderr.write("%-10s %8.3f seconds\n" % (phase, seconds))
 
 if __name__ == '__main__':
     main()
@@ -15,26 +15,361 @@ This file will likely only work in the final stages of the compiler
 project.  You may need to make modifications to it to get it to work.
 '''
 import sys
+import weakref
+from collections import Counter, OrderedDict, namedtuple
+from itertools import repeat
+from time import perf_counter
 from . import bblock
 
 
-class Frame(object):
+class Frame(list):
     '''
-    Object representing a stack frame.
+    Object representing a stack frame.  Temporaries and local variables
+    live in a list indexed by the slot numbers that BlockLinker assigns
+    to each name.
     '''
+    __slots__ = ('args',)
 
-    def __init__(self, args):
+    def __init__(self, args, nslots):
+        super(Frame, self).__init__(repeat(None, nslots))
         self.args = args
-        self.vars = {'return': None}
 
-    def __getitem__(self, name):
-        return self.vars[name]
 
-    def __setitem__(self, name, value):
-        self.vars[name] = value
+# Extern functions found by find_extern(), shared by all interpreters.
+# Maps (module names, function name) to the function.
+extern_cache = {}
 
-    def __contains__(self, name):
-        return name in self.vars
+# Python modules searched for extern functions by default
+external_lib_names = ['math', 'os']
+if sys.version_info.major >= 3:
+    external_lib_names.append('builtins')
+else:
+    external_lib_names.append('__builtin__')
+
+
+def find_extern(name, modules=None):
+    '''
+    Scan a list of Python modules (by default those named in
+    external_lib_names) for the function of an extern declaration.
+    Functions found are remembered in extern_cache.
+    '''
+    if modules is None:
+        modules = [__import__(module) for module in external_lib_names]
+    key = (tuple(module.__name__ for module in modules), name)
+    func = extern_cache.get(key)
+    if func is None:
+        for module in modules:
+            func = getattr(module, name, None)
+            if func:
+                break
+        else:
+            raise RuntimeError("No extern function %s found" % name)
+        extern_cache[key] = func
+    return func
+
+
+class DecodedFunction(object):
+    '''
+    A function ready to be executed by the interpreter.  code is the
+    list of decoded (handler, operands) pairs and nslots is the number
+    of frame slots needed by its temporaries and local variables.
+    opcodes holds the opcode name of each entry of code.
+    '''
+
+    def __init__(self, name, code, nslots, opcodes=None):
+        self.name = name
+        self.code = code
+        self.nslots = nslots
+        self.opcodes = opcodes
+
+
+def write_output(file, buffer):
+    '''
+    Write out and empty a buffer of program output.  A file of None
+    stands for sys.stdout as it is at the time of writing, written in
+    binary through its buffer or, for a text stream without one (such
+    as a StringIO under redirect_stdout()), decoded.  Text already
+    printed through sys.stdout goes first so that the order is kept.
+    '''
+    if not buffer:
+        return
+    sys.stdout.flush()
+    if file is None:
+        file = getattr(sys.stdout, 'buffer', None)
+    if file is None:
+        sys.stdout.write(buffer.decode('utf-8', 'replace'))
+        sys.stdout.flush()
+    else:
+        file.write(buffer)
+        file.flush()
+    del buffer[:]
+
+
+class Output(object):
+    '''
+    Buffered output of a Gone program.  The print instructions and the
+    builtin putchar() append to a buffer which is written to file (a
+    binary file, stdout by default) once it holds bufsize bytes, when
+    flush() is called, when the Output is garbage collected and when
+    Python exits.  With capture, output is kept in memory instead and
+    can be read with getvalue().
+    '''
+
+    def __init__(self, file=None, bufsize=8192, capture=False):
+        self.file = file
+        self.capture = capture
+        self.bufsize = bufsize
+        self.buffer = bytearray()
+        if not capture:
+            # The finalizer must not refer to self, only to what it
+            # writes.  It also runs when Python exits.
+            weakref.finalize(self, write_output, file, self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        if not self.capture and len(self.buffer) >= self.bufsize:
+            self.flush()
+
+    def print_value(self, value):
+        self.write(('%s\n' % value).encode('utf-8'))
+
+    def putchar(self, c):
+        self.write(bytes((c,)))
+        return c
+
+    def flush(self):
+        '''
+        Write out the buffered output (see write_output())
+        '''
+        if not self.capture:
+            write_output(self.file, self.buffer)
+
+    def getvalue(self):
+        '''
+        Return the captured output as a string
+        '''
+        return self.buffer.decode('utf-8', 'replace')
+
+
+class MemoCache(object):
+    '''
+    Cache of the results of a pure function keyed by the tuple of its
+    arguments.  Holds at most maxsize results (None for no limit),
+    evicting the least recently used one when full.
+    '''
+
+    # Returned by lookup() for arguments not in the cache
+    missing = object()
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        result = self.results.get(key, self.missing)
+        if result is self.missing:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return result
+
+    def store(self, key, result):
+        self.results[key] = result
+        if self.maxsize is not None and len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.results),
+            'maxsize': self.maxsize,
+        }
+
+
+class Profile(object):
+    '''
+    Execution profile collected by Interpreter.run_profiled().  For
+    every function it records the number of times and the total time
+    each code position executed, along with call counts and inclusive
+    time.  Per opcode and per basic block figures are derived from the
+    positions.
+
+    Calls are timed with the clock elapsed, the sum of the times of all
+    instructions executed so far, rather than with perf_counter(), so
+    that inclusive time leaves out the profiler's own bookkeeping just
+    like the times of the instructions do.
+    '''
+
+    def __init__(self, name="module"):
+        self.name = name
+
+        # Total time of the instructions executed
+        self.elapsed = 0.0
+
+        # Function name -> (DecodedFunction, [counts], [times])
+        self.positions = {}
+
+        # Function name -> [calls, primitive calls, inclusive time]
+        self.calls = {}
+
+        # (caller, callee) -> [calls, primitive calls, inclusive time]
+        self.callers = {}
+
+        # Stack of (function name, caller name, start time) and the
+        # number of active calls of each function
+        self.stack = []
+        self.active = Counter()
+
+    def counters(self, func):
+        '''
+        Return the count and time lists for the positions of func
+        '''
+        if func.name not in self.positions:
+            self.positions[func.name] = (func, [0] * len(func.code),
+                                         [0.0] * len(func.code))
+        return self.positions[func.name][1:]
+
+    def enter(self, func, now):
+        caller = self.stack[-1][0] if self.stack else None
+        primitive = int(self.active[func.name] == 0)
+        for key in (func.name, (caller, func.name)):
+            table = self.calls if key == func.name else self.callers
+            stats = table.setdefault(key, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += primitive
+        self.active[func.name] += 1
+        self.stack.append((func.name, caller, now))
+
+    def leave(self, now):
+        name, caller, start = self.stack.pop()
+        self.active[name] -= 1
+        # Recursive calls are already included in the outermost call
+        if self.active[name] == 0:
+            self.calls[name][2] += now - start
+            self.callers[caller, name][2] += now - start
+
+    def functions(self):
+        '''
+        Return a dict mapping function names to dicts of their calls,
+        instructions executed and inclusive and exclusive time.
+        '''
+        result = {}
+        for name, (func, counts, times) in self.positions.items():
+            calls, primitive, inclusive = self.calls.get(name, [0, 0, 0.0])
+            result[name] = {
+                'calls': calls,
+                'primitive_calls': primitive,
+                'instructions': sum(counts),
+                'inclusive': inclusive,
+                'exclusive': sum(times),
+            }
+        return result
+
+    def opcodes(self):
+        '''
+        Return a dict mapping opcodes to their count and total time
+        '''
+        result = {}
+        for func, counts, times in self.positions.values():
+            for opcode, count, time in zip(func.opcodes, counts, times):
+                if count:
+                    stats = result.setdefault(opcode,
+                                              {'count': 0, 'time': 0.0})
+                    stats['count'] += count
+                    stats['time'] += time
+        return result
+
+    def blocks(self, func):
+        '''
+        Return the (start, end) code positions of the basic blocks of
+        a DecodedFunction.
+        '''
+        leaders = {0}
+        for pc, (opcode, (handler, operands)) in enumerate(
+                zip(func.opcodes, func.code)):
+            if opcode == 'jump':
+                leaders.update((operands[0], pc + 1))
+            elif opcode.startswith('cbranch'):
+                leaders.update((operands[-2], operands[-1], pc + 1))
+            elif opcode.startswith('return_'):
+                leaders.add(pc + 1)
+        starts = sorted(pc for pc in leaders if pc < len(func.code))
+        return list(zip(starts, starts[1:] + [len(func.code)]))
+
+    def as_dict(self):
+        '''
+        Return the whole profile as a dict of JSON serializable data
+        '''
+        positions = {}
+        blocks = {}
+        for name, (func, counts, times) in self.positions.items():
+            positions[name] = [
+                {'pc': pc, 'opcode': opcode, 'count': count, 'time': time}
+                for pc, (opcode, count, time) in enumerate(
+                    zip(func.opcodes, counts, times))]
+            blocks[name] = [
+                {'start': start, 'end': end,
+                 'count': counts[start], 'time': sum(times[start:end])}
+                for start, end in self.blocks(func)]
+        return {
+            'program': self.name,
+            'functions': self.functions(),
+            'opcodes': self.opcodes(),
+            'blocks': blocks,
+            'positions': positions,
+        }
+
+    def dump_json(self, filename):
+        import json
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+    def dump_stats(self, filename):
+        '''
+        Write the function profile in the marshal format read by the
+        pstats module (as written by cProfile).
+        '''
+        import marshal
+
+        def key(name):
+            return (self.name, 0, name)
+
+        stats = {}
+        for name, info in self.functions().items():
+            callers = {}
+            for (caller, callee), (nc, cc, ct) in self.callers.items():
+                if callee == name and caller is not None:
+                    callers[key(caller)] = (nc, cc, 0.0, ct)
+            stats[key(name)] = (info['primitive_calls'], info['calls'],
+                                info['exclusive'], info['inclusive'],
+                                callers)
+        with open(filename, 'wb') as f:
+            marshal.dump(stats, f)
+
+    def print_summary(self, file=sys.stderr, limit=15):
+        functions = self.functions()
+        print("%-24s %10s %12s %12s %12s" % (
+            'function', 'calls', 'instructions', 'exclusive', 'inclusive'),
+            file=file)
+        for name, info in sorted(functions.items(),
+                                 key=lambda item: -item[1]['exclusive']):
+            print("%-24s %10d %12d %12.6f %12.6f" % (
+                name, info['calls'], info['instructions'],
+                info['exclusive'], info['inclusive']), file=file)
+        print(file=file)
+        print("%-24s %12s %12s" % ('opcode', 'count', 'time'), file=file)
+        opcodes = sorted(self.opcodes().items(),
+                         key=lambda item: -item[1]['time'])
+        for opcode, info in opcodes[:limit]:
+            print("%-24s %12d %12.6f" % (opcode, info['count'],
+                                         info['time']), file=file)
 
 
 class Interpreter(object):
@@ -58,8 +393,12 @@ class Interpreter(object):
              self.run_add_int('_int_1', '_int_2', '_int_3')
              self.run_print_int('_int_3')
 
-    To store the values of variables created in the intermediate
-    language, simply use a dictionary.
+    The run_opcode() methods are looked up once per function when the
+    code is registered (see decode()), not on every instruction.
+
+    The values of temporaries and local variables are stored in a
+    Frame, a list indexed by the slot numbers BlockLinker gives each
+    name when the code is linked.  Global variables use a dictionary.
 
     For external function declarations, allow specific Python modules
     (e.g., math, os, etc.) to be registered with the interpreter.
@@ -67,61 +406,322 @@ class Interpreter(object):
     to be a bit of sick hack.
     '''
 
-    def __init__(self, name="module"):
-        # Frame stack
+    def __init__(self, name="module", max_depth=None, profile=False,
+                 memoize=(), memo_size=1024, output=None):
+        self.name = name
+
+        # Where print instructions and putchar() write to
+        self.output = output or Output()
+
+        # Extern functions provided by the interpreter itself
+        self.builtins = {
+            'putchar': self.output.putchar,
+        }
+
+        # Frame stack.  Holds a (code, pc, frame, target) tuple for each
+        # active call with the state to resume in the caller.
         self.framestack = []
 
+        # Maximum number of nested calls (None for no limit)
+        self.max_depth = max_depth or sys.maxsize
+
+        # Code of the current function
+        self.code = None
+
         # Current stack frame
         self.frame = None
 
         # Current program counter
         self.pc = 0
 
+        # Value returned by the last function to return
+        self.retval = None
+
+        # Execution profile.  Profiling swaps in a separate dispatch
+        # loop so that run() itself carries no profiling overhead.
+        self.profile = None
+        if profile:
+            self.profile = Profile(name)
+            self.run = self.run_profiled
+
+        # Names of the pure functions whose results are cached (see
+        # gone/purity.py) and the wrappers that fill their caches
+        self.memoize = set(memoize)
+        self.memo_size = memo_size
+        self.memoized = {}
+
         # Global variables
         self.globals = {}
 
         # List of Python modules to search for external decls
-        external_libs = ['math', 'os']
-        if sys.version_info.major >= 3:
-            external_libs.append('builtins')
-        else:
-            external_libs.append('__builtin__')
-
-        self.external_libs = [__import__(name) for name in external_libs]
+        self.external_libs = [__import__(name)
+                              for name in external_lib_names]
 
     # Add user-defined functions to the globals.  Builds a dictionary mapping
-    # function names to the code associated with each function
+    # function names to the decoded code associated with each function
     def register_functions(self, functionlist):
         self.functions = {}
-        for func, code in functionlist:
-            self.functions[func.name] = code
+        for func, code, nslots in functionlist:
+            opcodes = [self.opcode(instr) for instr in code] + ['return_void']
+            self.functions[func.name] = DecodedFunction(
+                func.name, self.decode(code), nslots, opcodes)
+        for name in self.memoize & set(self.functions):
+            self.memoized[name] = self.memo_wrapper(self.functions[name])
+
+        # Names declared by extern_func, which take precedence over Gone
+        # functions in run_call_func()
+        self.externs = {instr[1] for func, code, nslots in functionlist
+                        for instr in code if instr[0] == 'extern_func'}
+        for func in self.functions.values():
+            self.bind_calls(func)
+
+    def bind_calls(self, func):
+        '''
+        Bind the call sites of a DecodedFunction to their targets.  A
+        call of a Gone function or an extern function becomes a handler
+        for its number of arguments that receives the DecodedFunction or
+        the Python function directly, instead of looking the name up and
+        building an argument list each time.  Calls that cannot be
+        resolved now keep run_call_func().
+        '''
+        for pc, (handler, operands) in enumerate(func.code):
+            opcode = func.opcodes[pc]
+            if opcode not in ('call_func', 'call_memo'):
+                continue
+            funcname, args, target = operands[0], operands[1:-1], operands[-1]
+            if opcode == 'call_memo':
+                kind, callee = 'call_memo', self.memoized[funcname]
+            elif funcname in self.externs:
+                try:
+                    kind, callee = 'call_extern', self.resolve_extern(funcname)
+                except RuntimeError:
+                    continue
+            elif funcname in self.functions:
+                kind, callee = 'call_gone', self.functions[funcname]
+            else:
+                continue
+            name = '%s_%d' % (kind, len(args))
+            if not hasattr(self, 'run_' + name):
+                name = kind
+            func.code[pc] = (getattr(self, 'run_' + name),
+                             (callee, target) + args)
+            func.opcodes[pc] = name
+
+    def resolve_extern(self, name):
+        '''
+        Find an extern function among the builtins or in the list of
+        external modules (see find_extern())
+        '''
+        if name in self.builtins:
+            return self.builtins[name]
+        return find_extern(name, self.external_libs)
+
+    def memo_wrapper(self, func):
+        '''
+        Make the function run on a cache miss of a memoized function.
+        It calls func with its own arguments into slot 0, stores the
+        result in the cache and returns it.
+        '''
+        cache = MemoCache(self.memo_size)
+        code = [
+            (self.run_memo_call, (func,)),
+            (self.run_memo_store, (cache,)),
+            (self.run_return_int, (0,)),
+        ]
+        wrapper = DecodedFunction(func.name + '[memo]', code, 1,
+                                  ['memo_call', 'memo_store', 'return_int'])
+        wrapper.cache = cache
+        return wrapper
+
+    def memo_stats(self):
+        '''
+        Return a dict mapping each memoized function to its cache stats
+        '''
+        return {name: wrapper.cache.stats()
+                for name, wrapper in sorted(self.memoized.items())}
+
+    def opcode(self, instr):
+        '''
+        Return the opcode an instruction runs as.  Calls of memoized
+        functions check the cache first.
+        '''
+        if instr[0] == 'call_func' and instr[1] in self.memoize:
+            return 'call_memo'
+        return instr[0]
+
+    def decode(self, code):
+        '''
+        Decode a linked instruction sequence into a list of
+        (handler, args) pairs.  The run_opcode() method of every
+        instruction is looked up once here rather than each time the
+        instruction executes.  Unknown opcodes are reported now and
+        replaced by a no-op so that jump targets stay valid.
+        '''
+        decoded = []
+        for instr in code:
+            opcode = self.opcode(instr)
+            handler = getattr(self, "run_" + opcode, None)
+            if handler is None:
+                print("Warning: No run_" + opcode + "() method")
+                handler = self.run_nop
+            decoded.append((handler, instr[1:]))
+
+        # Running off the end of the code returns from the function
+        decoded.append((self.run_return_void, ()))
+        return decoded
 
     def execute_function(self, funcname, args):
         '''
-        Run intermediate code in the interpreter.  ircode is a list
-        of instruction tuples.  Each instruction (opcode, *args) is
-        dispatched to a method self.run_opcode(*args)
+        Call a Gone function and run it to completion, returning its
+        result.  Calls between Gone functions do not recurse in Python;
+        they are control transfers handled by call() and the return
+        instructions within a single run() loop.
         '''
-        code = self.functions[funcname]
-        self.framestack.append((self.pc, self.frame))
-        self.frame = Frame(args)
-        self.pc = 0
-        while self.pc < len(code):
-            instr = code[self.pc]
-            opcode = instr[0]
+        depth = len(self.framestack)
+        saved = (self.code, self.pc, self.frame)
+        try:
+            self.call(self.functions[funcname], args, None)
+            self.run(depth)
+        except BaseException:
+            del self.framestack[depth:]
+            self.code, self.pc, self.frame = saved
+            raise
+        return self.retval
+
+    def start_function(self, funcname, args):
+        '''
+        Begin a call of a Gone function to be run in slices by resume()
+        '''
+        self.resume_depth = len(self.framestack)
+        self.call(self.functions[funcname], args, None)
+
+    def resume(self, fuel):
+        '''
+        Continue the function begun by start_function() for at most fuel
+        instructions.  Returns the number of instructions left over if
+        it returned (its result is in self.retval) or None if it ran out
+        of fuel and can be resumed again.
+        '''
+        try:
+            return self.run_metered(self.resume_depth, fuel)
+        except BaseException:
+            del self.framestack[self.resume_depth:]
+            raise
+
+    def run(self, depth):
+        '''
+        Dispatch loop.  Each decoded entry (handler, operands) is
+        dispatched as handler(*operands).  Handlers that transfer
+        control to another function return True so the loop picks up
+        the new code.  Runs until the frame stack drops back to depth.
+        '''
+        code = self.code
+        while True:
+            handler, operands = code[self.pc]
             self.pc += 1
-            if hasattr(self, "run_" + opcode):
-                getattr(self, "run_" + opcode)(*instr[1:])
-            else:
-                print("Warning: No run_" + opcode + "() method")
-            if self.pc < 0:
-                break
-        result = self.frame['return']
-        self.pc, self.frame = self.framestack.pop()
-        return result
+            if handler(*operands):
+                if len(self.framestack) == depth:
+                    break
+                code = self.code
+
+    def run_metered(self, depth, fuel):
+        '''
+        Dispatch loop used by resume().  Works like run() but stops
+        after fuel instructions, leaving the state in place to continue
+        later.  Returns the fuel left when the frame stack dropped back
+        to depth, otherwise None.
+        '''
+        code = self.code
+        while fuel:
+            handler, operands = code[self.pc]
+            self.pc += 1
+            fuel -= 1
+            if handler(*operands):
+                if len(self.framestack) == depth:
+                    return fuel
+                code = self.code
+        return None
+
+    def run_profiled(self, depth):
+        '''
+        Dispatch loop used when profiling.  Works like run() but also
+        records the count and time of every instruction executed as
+        well as the calls and returns between functions in self.profile.
+        The clock is read again after the bookkeeping, so its cost is
+        not charged to the next instruction, and calls are timed by the
+        sum of the instruction times (see Profile).
+        '''
+        profile = self.profile
+        clock = perf_counter
+        functions = {id(func.code): func for func in self.functions.values()}
+        functions.update((id(func.code), func)
+                         for func in self.memoized.values())
+
+        code = self.code
+        func = functions[id(code)]
+        counts, times = profile.counters(func)
+        level = len(self.framestack)
+        elapsed = profile.elapsed
+        profile.enter(func, elapsed)
+        last = clock()
+        while True:
+            pc = self.pc
+            handler, operands = code[pc]
+            self.pc = pc + 1
+            transfer = handler(*operands)
+            time = clock() - last
+            counts[pc] += 1
+            times[pc] += time
+            elapsed += time
+            if transfer:
+                if len(self.framestack) > level:
+                    code = self.code
+                    func = functions[id(code)]
+                    profile.enter(func, elapsed)
+                else:
+                    profile.leave(elapsed)
+                    if len(self.framestack) == depth:
+                        profile.elapsed = elapsed
+                        break
+                    code = self.code
+                    func = functions[id(code)]
+                level = len(self.framestack)
+                counts, times = profile.counters(func)
+            last = clock()
+
+    def call(self, func, args, target):
+        '''
+        Transfer control to the start of a DecodedFunction.  The state
+        of the caller is saved on the frame stack and restored when the
+        function returns, storing its result in slot target.
+        '''
+        if len(self.framestack) >= self.max_depth:
+            raise RuntimeError("Maximum call depth of %d exceeded calling %s"
+                               % (self.max_depth, func.name))
+        self.framestack.append((self.code, self.pc, self.frame, target))
+        self.code = func.code
+        self.frame = Frame(args, func.nslots)
+        self.pc = 0
+        return True
+
+    def return_value(self, value):
+        '''
+        Return control to the caller of the current function
+        '''
+        self.code, self.pc, self.frame, target = self.framestack.pop()
+        if target is not None:
+            self.frame[target] = value
+        self.retval = value
+        return True
 
     # Interpreter opcodes
 
+    def run_nop(self, *args):
+        '''
+        Placeholder for instructions without a run_opcode() method
+        '''
+        pass
+
     def run_literal_int(self, value, target):
         '''
         Create a literal integer value
@@ -138,7 +738,7 @@ class Interpreter(object):
         '''
         Output an integer value.
         '''
-        print(self.frame[source])
+        self.output.print_value(self.frame[source])
 
     run_literal_float = run_literal_int
     run_literal_string = run_literal_int
@@ -169,25 +769,34 @@ class Interpreter(object):
     def run_global_bool(self, name):
         self.globals[name] = False
 
-    def run_store_int(self, source, target):
-        if target in self.frame:
-            self.frame[target] = self.frame[source]
-        else:
-            self.globals[target] = self.frame[source]
+    # Local variables live in frame slots, globals in self.globals
+    def run_store_local_int(self, source, target):
+        self.frame[target] = self.frame[source]
 
-    run_store_float = run_store_int
-    run_store_string = run_store_int
-    run_store_bool = run_store_int
+    run_store_local_float = run_store_local_int
+    run_store_local_string = run_store_local_int
+    run_store_local_bool = run_store_local_int
 
-    def run_load_int(self, name, target):
-        if name in self.frame:
-            self.frame[target] = self.frame[name]
-        else:
-            self.frame[target] = self.globals[name]
+    def run_store_global_int(self, source, target):
+        self.globals[target] = self.frame[source]
+
+    run_store_global_float = run_store_global_int
+    run_store_global_string = run_store_global_int
+    run_store_global_bool = run_store_global_int
+
+    def run_load_local_int(self, name, target):
+        self.frame[target] = self.frame[name]
 
-    run_load_float = run_load_int
-    run_load_string = run_load_int
-    run_load_bool = run_load_int
+    run_load_local_float = run_load_local_int
+    run_load_local_string = run_load_local_int
+    run_load_local_bool = run_load_local_int
+
+    def run_load_global_int(self, name, target):
+        self.frame[target] = self.globals[name]
+
+    run_load_global_float = run_load_global_int
+    run_load_global_string = run_load_global_int
+    run_load_global_bool = run_load_global_int
 
     def run_add_int(self, left, right, target):
         self.frame[target] = self.frame[left] + self.frame[right]
@@ -222,7 +831,7 @@ class Interpreter(object):
     run_usub_float = run_usub_int
 
     def run_print_int(self, source):
-        print(self.frame[source])
+        self.output.print_value(self.frame[source])
 
     run_print_float = run_print_int
     run_print_string = run_print_int
@@ -230,20 +839,14 @@ class Interpreter(object):
 
     def run_extern_func(self, name, rettypename, *parmtypenames):
         '''
-        Scan the list of external modules for a matching function name.
         Place a reference to the external function in the dict of vars.
         '''
-        for module in self.external_libs:
-            func = getattr(module, name, None)
-            if func:
-                self.globals[name] = func
-                break
-        else:
-            raise RuntimeError("No extern function %s found" % name)
+        self.globals[name] = self.resolve_extern(name)
 
     def run_call_func(self, funcname, *args):
         '''
-        Call a previously declared external function.
+        Call a previously declared external function or transfer
+        control to a Gone function.
         '''
         target = args[-1]
         argvals = [self.frame[name] for name in args[:-1]]
@@ -251,10 +854,62 @@ class Interpreter(object):
             func = self.globals[funcname]
             self.frame[target] = func(*argvals)
         elif funcname in self.functions:
-            result = self.execute_function(funcname, argvals)
-            self.frame[target] = result
+            return self.call(self.functions[funcname], argvals, target)
         else:
-            raise RuntimeError("No function %s found" % name)
+            raise RuntimeError("No function %s found" % funcname)
+
+    # Calls bound by bind_calls().  The callee and the target slot come
+    # first, followed by the slots of the arguments.
+    def run_call_gone(self, func, target, *args):
+        frame = self.frame
+        return self.call(func, [frame[name] for name in args], target)
+
+    def run_call_gone_0(self, func, target):
+        return self.call(func, [], target)
+
+    def run_call_gone_1(self, func, target, a):
+        return self.call(func, [self.frame[a]], target)
+
+    def run_call_gone_2(self, func, target, a, b):
+        frame = self.frame
+        return self.call(func, [frame[a], frame[b]], target)
+
+    def run_call_gone_3(self, func, target, a, b, c):
+        frame = self.frame
+        return self.call(func, [frame[a], frame[b], frame[c]], target)
+
+    def run_call_extern(self, func, target, *args):
+        frame = self.frame
+        frame[target] = func(*[frame[name] for name in args])
+
+    def run_call_extern_0(self, func, target):
+        self.frame[target] = func()
+
+    def run_call_extern_1(self, func, target, a):
+        frame = self.frame
+        frame[target] = func(frame[a])
+
+    def run_call_extern_2(self, func, target, a, b):
+        frame = self.frame
+        frame[target] = func(frame[a], frame[b])
+
+    def run_call_memo(self, wrapper, target, *args):
+        '''
+        Call a memoized Gone function.  On a cache hit the result is
+        stored directly, otherwise control is transferred to the
+        wrapper made by memo_wrapper().
+        '''
+        argvals = [self.frame[name] for name in args]
+        result = wrapper.cache.lookup(tuple(argvals))
+        if result is MemoCache.missing:
+            return self.call(wrapper, argvals, target)
+        self.frame[target] = result
+
+    def run_memo_call(self, func):
+        return self.call(func, self.frame.args, 0)
+
+    def run_memo_store(self, cache):
+        cache.store(tuple(self.frame.args), self.frame[0])
 
     def run_lt_int(self, left, right, target):
         self.frame[target] = self.frame[left] < self.frame[right]
@@ -304,15 +959,14 @@ class Interpreter(object):
         self.frame[target] = not self.frame[source]
 
     def run_return_int(self, source):
-        self.frame['return'] = self.frame[source]
-        self.pc = -1
+        return self.return_value(self.frame[source])
+
     run_return_float = run_return_int
     run_return_string = run_return_int
     run_return_bool = run_return_int
 
     def run_return_void(self):
-        self.frame['return'] = None
-        self.pc = -1
+        return self.return_value(None)
 
     def run_parm_int(self, name, num):
         self.frame[name] = self.frame.args[num]
@@ -330,20 +984,184 @@ class Interpreter(object):
         else:
             self.pc = false_target
 
+    # Superinstructions created by BlockLinker.fuse().  The _const forms
+    # take a literal value in place of their right operand.
+
+    def run_add_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] + value
+
+    run_add_float_const = run_add_int_const
+    run_add_string_const = run_add_int_const
+
+    def run_sub_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] - value
+
+    run_sub_float_const = run_sub_int_const
+
+    def run_mul_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] * value
+
+    run_mul_float_const = run_mul_int_const
+
+    def run_div_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] // value
+
+    def run_div_float_const(self, left, value, target):
+        self.frame[target] = self.frame[left] / value
+
+    def run_lt_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] < value
+
+    run_lt_float_const = run_lt_int_const
+    run_lt_string_const = run_lt_int_const
+
+    def run_le_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] <= value
+
+    run_le_float_const = run_le_int_const
+    run_le_string_const = run_le_int_const
+
+    def run_gt_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] > value
+
+    run_gt_float_const = run_gt_int_const
+    run_gt_string_const = run_gt_int_const
+
+    def run_ge_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] >= value
+
+    run_ge_float_const = run_ge_int_const
+    run_ge_string_const = run_ge_int_const
+
+    def run_eq_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] == value
+
+    run_eq_float_const = run_eq_int_const
+    run_eq_string_const = run_eq_int_const
+    run_eq_bool_const = run_eq_int_const
+
+    def run_ne_int_const(self, left, value, target):
+        self.frame[target] = self.frame[left] != value
+
+    run_ne_float_const = run_ne_int_const
+    run_ne_string_const = run_ne_int_const
+    run_ne_bool_const = run_ne_int_const
+
+    # Comparison followed by a conditional branch
+    def run_cbranch_lt(self, left, right, true_target, false_target):
+        if self.frame[left] < self.frame[right]:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_le(self, left, right, true_target, false_target):
+        if self.frame[left] <= self.frame[right]:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_gt(self, left, right, true_target, false_target):
+        if self.frame[left] > self.frame[right]:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_ge(self, left, right, true_target, false_target):
+        if self.frame[left] >= self.frame[right]:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_eq(self, left, right, true_target, false_target):
+        if self.frame[left] == self.frame[right]:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_ne(self, left, right, true_target, false_target):
+        if self.frame[left] != self.frame[right]:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_lt_const(self, left, value, true_target, false_target):
+        if self.frame[left] < value:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_le_const(self, left, value, true_target, false_target):
+        if self.frame[left] <= value:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_gt_const(self, left, value, true_target, false_target):
+        if self.frame[left] > value:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_ge_const(self, left, value, true_target, false_target):
+        if self.frame[left] >= value:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_eq_const(self, left, value, true_target, false_target):
+        if self.frame[left] == value:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
+    def run_cbranch_ne_const(self, left, value, true_target, false_target):
+        if self.frame[left] != value:
+            self.pc = true_target
+        else:
+            self.pc = false_target
+
 # BlockLinker.  This block visitor walks through the block structure
 # and turns it into a single sequence of instructions with added
 # jump and cbranch instructions.
 
+# Operators that fuse() can give a literal right operand (_const forms)
+const_ops = {'add', 'sub', 'mul', 'div', 'lt', 'le', 'gt', 'ge', 'eq', 'ne'}
+
+# Operators whose literal left operand can be moved to the right,
+# mapped to the operator to use after swapping the operands
+swapped_ops = {
+    'add': 'add',
+    'mul': 'mul',
+    'lt': 'gt',
+    'le': 'ge',
+    'gt': 'lt',
+    'ge': 'le',
+    'eq': 'eq',
+    'ne': 'ne',
+}
+
+# Comparisons that fuse() can merge with a following cbranch
+compare_ops = {'lt', 'le', 'gt', 'ge', 'eq', 'ne'}
+
 
 class BlockLinker(bblock.BlockVisitor):
 
-    def __init__(self):
+    def __init__(self, fuse=True):
+        # Run the superinstruction pass (see fuse())
+        self.fuse_code = fuse
+
+        # Number of instructions removed by each kind of fusion
+        self.fusions = Counter()
+
         # The single sequence of code
         self.code = []
 
         # Mapping of block ids to code positions
         self.blockmap = {}
 
+        # Mapping of temporary and local variable names to frame slots
+        self.slots = {}
+
     def link_blocks(self, start_block):
         # Visit the starting block
         self.visit(start_block)
@@ -359,6 +1177,248 @@ class BlockLinker(bblock.BlockVisitor):
                             id(instr[2])], self.blockmap[id(instr[3])])
                 self.code[n] = newinstr
 
+        # Give temporaries and local variables frame slots
+        self.resolve_slots()
+
+        if self.fuse_code:
+            self.fuse()
+
+    @property
+    def nslots(self):
+        return len(self.slots)
+
+    def name_operands(self, instr):
+        '''
+        Return the positions of the operands of instr that name a
+        temporary or a local variable.
+        '''
+        opcode = instr[0]
+        if opcode in ('jump', 'extern_func') or opcode.startswith('global_'):
+            return ()
+        elif opcode == 'cbranch' or opcode.startswith(('parm_',
+                                                       'store_global_')):
+            return (1,)
+        elif opcode.startswith('load_global_'):
+            return (2,)
+        elif opcode.startswith('literal_'):
+            return (2,)
+        elif opcode == 'call_func':
+            return range(2, len(instr))
+        else:
+            return range(1, len(instr))
+
+    def resolve_slots(self):
+        '''
+        Number every temporary and local variable of the function with
+        a dense frame slot and rewrite the operands to use the slots.
+        Global variables keep their names.
+        '''
+        for n, instr in enumerate(self.code):
+            operands = list(instr)
+            for pos in self.name_operands(instr):
+                operands[pos] = self.slots.setdefault(instr[pos],
+                                                      len(self.slots))
+            self.code[n] = tuple(operands)
+
+    def operand_uses(self, instr):
+        '''
+        Return lists of the positions of the frame slot operands that
+        instr reads and writes.
+        '''
+        opcode = instr[0]
+        positions = list(self.name_operands(instr))
+        if opcode.startswith(('print_', 'return_', 'store_global_')) or \
+                opcode == 'cbranch':
+            writes = []
+        else:
+            writes = positions[-1:]
+        reads = [n for n in positions if n not in writes]
+        return reads, writes
+
+    def jump_target(self, target):
+        '''
+        Follow a chain of jumps starting at target to its final target
+        '''
+        seen = set()
+        while (target < len(self.code) and self.code[target][0] == 'jump' and
+               target not in seen):
+            seen.add(target)
+            target = self.code[target][1]
+        return target
+
+    def thread_jumps(self):
+        '''
+        Retarget jumps and branches that point at another jump.
+        '''
+        for n, instr in enumerate(self.code):
+            if instr[0] == 'jump':
+                targets = instr[1:]
+            elif instr[0] == 'cbranch':
+                targets = instr[2:]
+            else:
+                continue
+            threaded = tuple(self.jump_target(t) for t in targets)
+            if threaded != targets:
+                self.fusions['thread_jump'] += sum(
+                    a != b for a, b in zip(targets, threaded))
+                self.code[n] = instr[:len(instr) - len(targets)] + threaded
+
+    def fuse(self):
+        '''
+        Peephole pass over the slot resolved code that threads jumps and
+        merges common instruction sequences into superinstructions:
+
+        store_forward    op ... t; store t x       ->  op ... x
+        load_forward     load x t; ... op t ...    ->  op x ...
+        literal_operand  literal v t; op a t u     ->  op_const a v u
+        compare_branch   lt a b t; cbranch t L M   ->  cbranch_lt a b L M
+        jump_next        jump to the next instruction is removed
+
+        Only single use temporaries of local variables are forwarded
+        and nothing is fused across a jump target.  self.fusions counts
+        the instructions removed by each fusion, which is the number of
+        dispatches saved each time the code runs through once.
+        '''
+        self.thread_jumps()
+        code = self.code
+        deleted = [False] * len(code)
+
+        # Jump targets start new basic blocks
+        leaders = {0}
+        for instr in code:
+            if instr[0] == 'jump':
+                leaders.add(instr[1])
+            elif instr[0] == 'cbranch':
+                leaders.update(instr[2:])
+
+        # Number of times each slot is read
+        uses = Counter()
+        for instr in code:
+            for pos in self.operand_uses(instr)[0]:
+                uses[instr[pos]] += 1
+
+        # Have a temporary that is only stored into a local variable
+        # written directly into the variable
+        for n in range(len(code) - 1):
+            instr, store = code[n], code[n + 1]
+            if (not store[0].startswith('store_local_') or
+                    n + 1 in leaders or uses[store[1]] != 1 or
+                    instr[0].startswith(('store_', 'alloc_', 'parm_'))):
+                continue
+            writes = self.operand_uses(instr)[1]
+            if writes and instr[writes[0]] == store[1]:
+                pos = writes[0]
+                code[n] = instr[:pos] + (store[2],) + instr[pos + 1:]
+                deleted[n + 1] = True
+                self.fusions['store_forward'] += 1
+
+        # Forward local variable loads and literals to their single use
+        # within the same basic block.  Only temporaries are forwarded:
+        # after store_forward a load or literal can write a local
+        # variable, which may be written again before it is read.
+        temps = {slot for name, slot in self.slots.items()
+                 if name.startswith('__')}
+        copies = {}
+        constants = {}
+        for n, instr in enumerate(code):
+            if n in leaders:
+                copies.clear()
+                constants.clear()
+            if deleted[n]:
+                continue
+            reads, writes = self.operand_uses(instr)
+            operands = list(instr)
+            for pos in reads:
+                if instr[pos] in copies:
+                    load, var = copies.pop(instr[pos])
+                    operands[pos] = var
+                    deleted[load] = True
+                    self.fusions['load_forward'] += 1
+            instr = code[n] = self.fold_literal(tuple(operands), constants,
+                                                deleted)
+
+            # A slot written here can no longer be forwarded
+            for pos in writes:
+                for temp, (load, var) in list(copies.items()):
+                    if instr[pos] in (temp, var):
+                        del copies[temp]
+                constants.pop(instr[pos], None)
+
+            opcode = instr[0]
+            if opcode.startswith('load_local_'):
+                if instr[2] in temps and uses[instr[2]] == 1:
+                    copies[instr[2]] = (n, instr[1])
+            elif opcode.startswith('literal_'):
+                if instr[2] in temps and uses[instr[2]] == 1:
+                    constants[instr[2]] = (n, instr[1])
+            elif opcode in ('jump', 'cbranch') or opcode.startswith('return_'):
+                copies.clear()
+                constants.clear()
+
+        # Merge comparisons with the conditional branch testing them
+        live = [n for n in range(len(code)) if not deleted[n]]
+        for n, m in zip(live, live[1:]):
+            instr, branch = code[n], code[m]
+            kind = instr[0].split('_')[0]
+            if (branch[0] != 'cbranch' or kind not in compare_ops or
+                    instr[-1] != branch[1] or uses[branch[1]] != 1 or
+                    any(pos in leaders for pos in range(n + 1, m + 1))):
+                continue
+            opcode = 'cbranch_' + kind
+            if instr[0].endswith('_const'):
+                opcode += '_const'
+            code[n] = (opcode,) + instr[1:3] + branch[2:]
+            deleted[m] = True
+            self.fusions['compare_branch'] += 1
+
+        # Remove jumps to the instruction that follows anyway
+        live = [n for n in range(len(code)) if not deleted[n]]
+        for n, m in zip(live, live[1:] + [len(code)]):
+            if code[n][0] == 'jump' and n < code[n][1] <= m and not any(
+                    not deleted[pos] for pos in range(n + 1, code[n][1])):
+                deleted[n] = True
+                self.fusions['jump_next'] += 1
+
+        # Compact the code and renumber the jump targets.  A removed
+        # instruction maps to the next one that remains.
+        newpos = []
+        for n in range(len(code)):
+            newpos.append(n - sum(deleted[:n]))
+        newpos.append(len(code) - sum(deleted))
+        self.code = []
+        for n, instr in enumerate(code):
+            if deleted[n]:
+                continue
+            if instr[0] == 'jump':
+                instr = ('jump', newpos[instr[1]])
+            elif instr[0].startswith('cbranch'):
+                instr = instr[:-2] + (newpos[instr[-2]], newpos[instr[-1]])
+            self.code.append(instr)
+
+    def fold_literal(self, instr, constants, deleted):
+        '''
+        Replace an operand of a binary operator that comes from a
+        pending literal with the literal value (the _const forms).
+        '''
+        opcode = instr[0]
+        kind = opcode.split('_')[0]
+        if kind not in const_ops or len(instr) != 4:
+            return instr
+        left, right, target = instr[1:]
+        if right in constants:
+            literal, value = constants.pop(right)
+            opcode += '_const'
+        elif (left in constants and kind in swapped_ops and
+              not opcode.endswith('_string')):
+            literal, value = constants.pop(left)
+            left = right
+            opcode = swapped_ops[kind] + opcode[len(kind):] + '_const'
+        else:
+            return instr
+        deleted[literal] = True
+        self.fusions['literal_operand'] += 1
+        return (opcode, left, value, target)
+
     def visit_BasicBlock(self, block):
         self.blockmap[id(block)] = len(self.code)
         self.code.extend(block.instructions)
@@ -400,43 +1460,328 @@ class BlockLinker(bblock.BlockVisitor):
         # Insert the jump back to the loop test
         self.code.append(('jump', block))
 
+
+def link_functions(functions, fuse=True, fusions=None):
+    '''
+    Link the blocks of each function in a list of ircode.Function
+    objects.  Returns a list of (func, code, nslots) tuples suitable
+    for Interpreter.register_functions().  If fusions is a Counter,
+    the fusion counts of all functions are added to it.
+    '''
+    linked_functions = []
+    for func in functions:
+        linker = BlockLinker(fuse)
+        linker.link_blocks(func.start_block)
+        linked_functions.append((func, linker.code, linker.nslots))
+        if fusions is not None:
+            fusions.update(linker.fusions)
+    return linked_functions
+
+
+# Names of the available execution engines.  'interp' runs the linked
+# code in Interpreter, 'python' translates every function to Python
+# source with gone/pygen.py and 'tiered' compiles hot functions to
+# native code with gone/tiered.py.
+engines = ('interp', 'python', 'tiered')
+
+
+def create_interpreter(functions, engine='interp', fuse=True, fusions=None,
+                       max_depth=None, profile=False, memoize=False,
+                       memo_size=1024, output=None, threshold=1000):
+    '''
+    Create an interpreter for a list of ircode.Function objects using
+    the named engine and register the functions with it.  fuse and
+    fusions are passed on to link_functions().  max_depth and profile
+    are passed on to Interpreter, max_depth also to the python engine.
+    If memoize is true, the results of the pure functions (see
+    gone/purity.py) are cached, keeping at most memo_size results per
+    function.  The program writes to output, an
+    Output (a new one writing to stdout if None).  threshold is the
+    count of calls and loop iterations after which the tiered engine
+    compiles a function.
+    '''
+    pure = ()
+    if memoize:
+        from .purity import pure_functions
+        pure = pure_functions(functions)
+
+    if engine == 'python':
+        from .pygen import PythonInterpreter
+        interpreter = PythonInterpreter(max_depth=max_depth, memoize=pure,
+                                        memo_size=memo_size, output=output)
+        interpreter.register_functions(functions)
+    else:
+        cls = Interpreter
+        options = {}
+        if engine == 'tiered':
+            from .tiered import TieredInterpreter as cls
+            options['threshold'] = threshold
+        interpreter = cls(max_depth=max_depth, profile=profile,
+                          memoize=pure, memo_size=memo_size,
+                          output=output, **options)
+        interpreter.register_functions(
+            link_functions(functions, fuse, fusions))
+    return interpreter
+
+# ----------------------------------------------------------------------
+# Batch execution
+#
+# run_batch() runs many jobs in a pool of worker processes.  The linked
+# code of all programs is sent to each worker once, when it starts, in
+# a compact form without the block graph of the ircode.Function
+# objects.  A job then only names the program, the function and the
+# arguments to call it with.
+# ----------------------------------------------------------------------
+
+# What the interpreter needs to know of an ircode.Function
+Signature = namedtuple('Signature', ['name', 'return_type', 'parameters'])
+
+
+def compact_functions(linked_functions):
+    '''
+    Replace the ircode.Function objects of linked functions (as made by
+    link_functions()) by their Signature
+    '''
+    return [(Signature(func.name, func.return_type, func.parameters),
+             code, nslots)
+            for func, code, nslots in linked_functions]
+
+
+# Interpreters of the worker process, one per program, made by
+# init_worker()
+worker_interpreters = None
+
+
+def init_worker(programs):
+    '''
+    Register (and so decode) every program once per worker process
+    '''
+    global worker_interpreters
+    worker_interpreters = []
+    for functions in programs:
+        interpreter = Interpreter(output=Output(capture=True))
+        interpreter.register_functions(functions)
+        worker_interpreters.append(interpreter)
+
+
+def run_job(job):
+    '''
+    Run a (program, funcname, args) job in a worker.  The program's
+    global variables and output start out empty and __init is run
+    first.  Returns (result, output, error) where error is the message
+    of the exception that stopped the job or None.
+    '''
+    program, funcname, args = job
+    interpreter = worker_interpreters[program]
+    interpreter.globals = {}
+    output = interpreter.output
+    del output.buffer[:]
+    try:
+        interpreter.execute_function('__init', [])
+        result = interpreter.execute_function(funcname, list(args))
+    except RuntimeError as e:
+        return None, output.getvalue(), str(e)
+    except Exception as e:
+        return None, output.getvalue(), '%s: %s' % (type(e).__name__, e)
+    return result, output.getvalue(), None
+
+
+def run_batch(programs, jobs, workers=None, chunksize=1):
+    '''
+    Run a list of (program, funcname, args) jobs, where program is an
+    index into programs, a list of compacted linked programs (see
+    compact_functions()).  Uses a pool of workers processes (one per
+    CPU by default) which are given chunksize jobs at a time.  Returns
+    the (result, output, error) of each job in order.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers, initializer=init_worker,
+                             initargs=(programs,)) as pool:
+        return list(pool.map(run_job, jobs, chunksize=chunksize))
+
+
+def batch_main(opts):
+    '''
+    Run python3 -m gone.interp --batch.  Every file is a program run
+    with its main(), or with --call, a function run once per argument
+    set.
+    '''
+    import io
+    import time
+    from contextlib import redirect_stdout
+    from .ircode import compile_ircode
+    from .errors import errors_reported
+
+    start = time.perf_counter()
+    programs = []
+    for filename in opts.filenames:
+        with redirect_stdout(io.StringIO()):
+            functions = compile_ircode(open(filename).read())
+        if errors_reported():
+            raise SystemExit(1)
+        programs.append(compact_functions(link_functions(functions,
+                                                         opts.fuse)))
+
+    argsets = [[]]
+    if opts.call:
+        argsets = [[parse_value(arg) for arg in line.split()]
+                   for line in opts.args or []]
+        if opts.args_file:
+            with open(opts.args_file) as f:
+                argsets += [[parse_value(arg) for arg in line.split()]
+                            for line in f if line.strip()]
+    jobs = [(program, opts.call or 'main', args)
+            for program in range(len(programs)) for args in argsets]
+    compiled = time.perf_counter()
+
+    results = run_batch(programs, jobs, opts.workers, opts.chunksize)
+    finished = time.perf_counter()
+
+    for (program, funcname, args), (result, output, error) in zip(jobs,
+                                                                  results):
+        print("==> %s %s(%s) <==" % (opts.filenames[program], funcname,
+                                     ', '.join(map(str, args))))
+        sys.stdout.write(output)
+        if error is not None:
+            print("Runtime error: %s" % error)
+        else:
+            print("Program Returned: %s" % result)
+    sys.stderr.write("%d jobs in %.3f seconds (%.1f jobs/sec), compiled "
+                     "%d programs in %.3f seconds\n" % (
+                         len(jobs), finished - compiled,
+                         len(jobs) / (finished - compiled), len(programs),
+                         compiled - start))
+
+
+def parse_value(text):
+    '''
+    Convert a command line argument to a Gone int, float or bool
+    '''
+    if text in ('true', 'false'):
+        return text == 'true'
+    return float(text) if '.' in text or 'e' in text else int(text)
+
 # ----------------------------------------------------------------------
 #                       DO NOT MODIFY ANYTHING BELOW
 # ----------------------------------------------------------------------
 
 
 def main():
-    import sys
+    import argparse
     from .ircode import compile_ircode
     from .errors import errors_reported
 
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: python3 -m gone.interp filename\n")
-        raise SystemExit(1)
-
-    source = open(sys.argv[1]).read()
+    parser = argparse.ArgumentParser(prog='python3 -m gone.interp')
+    parser.add_argument('filenames', nargs='+', metavar='filename')
+    parser.add_argument('-e', '--engine', choices=engines, default='interp',
+                        help='execution engine (default: interp)')
+    parser.add_argument('--no-fuse', dest='fuse', action='store_false',
+                        help='do not fuse instructions into '
+                        'superinstructions')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='maximum depth of nested Gone calls')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the program and print a summary')
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help='write the profile to FILE as JSON')
+    parser.add_argument('--profile-pstats', metavar='FILE',
+                        help='write the function profile to FILE in '
+                        'pstats format')
+    parser.add_argument('--memoize', action='store_true',
+                        help='cache the results of pure functions')
+    parser.add_argument('--memo-size', type=int, default=1024,
+                        help='maximum number of cached results per '
+                        'function (default: 1024)')
+    parser.add_argument('--memo-stats', action='store_true',
+                        help='report the cache hits and misses of each '
+                        'memoized function')
+    parser.add_argument('--tier-threshold', type=int, default=1000,
+                        help='calls and loop iterations after which the '
+                        'tiered engine compiles a function (default: 1000)')
+    parser.add_argument('--tier-stats', action='store_true',
+                        help='report the functions compiled by the tiered '
+                        'engine')
+    parser.add_argument('--buffer-size', type=int, default=8192,
+                        help='bytes of program output to buffer before '
+                        'writing (default: 8192)')
+    parser.add_argument('--fusion-stats', action='store_true',
+                        help='report the instructions removed by each '
+                        'fusion')
+    batch = parser.add_argument_group('batch execution')
+    batch.add_argument('--batch', action='store_true',
+                       help='run all files in a pool of worker processes')
+    batch.add_argument('--call', metavar='FUNC',
+                       help='function to call with each argument set '
+                       'instead of main()')
+    batch.add_argument('--args', action='append', metavar='ARGS',
+                       help='space separated arguments for --call '
+                       '(repeatable)')
+    batch.add_argument('--args-file', metavar='FILE',
+                       help='file with one argument set per line')
+    batch.add_argument('-j', '--workers', type=int, default=None,
+                       help='number of worker processes (default: CPUs)')
+    batch.add_argument('--chunksize', type=int, default=1,
+                       help='jobs sent to a worker at a time')
+    opts = parser.parse_args()
+    if opts.batch:
+        return batch_main(opts)
+    if len(opts.filenames) != 1:
+        parser.error('more than one file requires --batch')
+    opts.filename = opts.filenames[0]
+    profile = opts.profile or opts.profile_json or opts.profile_pstats
+    if profile and opts.engine == 'python':
+        parser.error('profiling requires the interp engine')
+
+    source = open(opts.filename).read()
     functions = compile_ircode(source)
     if not errors_reported():
-        # Take the list of functions and build fully linked versions
-        linked_functions = []
-        for func in functions:
-            linker = BlockLinker()
-            linker.link_blocks(func.start_block)
-            linked_functions.append((func, linker.code))
-
-        # Monkey patch os with a putchar() function so certain examples work
-        import os
-        os.putchar = lambda x: os.write(1, chr(x).encode('latin-1'))
-
-        interpreter = Interpreter()
-        interpreter.register_functions(linked_functions)
-        # Execute the __init function which is responsible for global vars and
-        # constants
-        interpreter.execute_function('__init', [])
-
-        # Execute the main() entry point
-        result = interpreter.execute_function('main', [])
+        # Link (or translate) the functions for the selected engine
+        fusions = Counter()
+        output = Output(bufsize=opts.buffer_size)
+        interpreter = create_interpreter(functions, opts.engine, opts.fuse,
+                                         fusions, opts.max_depth, profile,
+                                         opts.memoize, opts.memo_size,
+                                         output, opts.tier_threshold)
+        if opts.fusion_stats:
+            for name, count in fusions.most_common():
+                sys.stderr.write("%-16s %6d\n" % (name, count))
+
+        try:
+            # Execute the __init function which is responsible for global
+            # vars and constants
+            interpreter.execute_function('__init', [])
+
+            # Execute the main() entry point
+            result = interpreter.execute_function('main', [])
+        except RuntimeError as e:
+            output.flush()
+            sys.stderr.write("Runtime error: %s\n" % e)
+            raise SystemExit(1)
+        output.flush()
         print("Program Returned: %d" % result)
 
+        if opts.tier_stats and opts.engine == 'tiered':
+            for name, (count, compiled) in interpreter.tier_stats().items():
+                sys.stderr.write("%-16s %8d %s\n" % (
+                    name, count, {True: 'compiled', False: 'interpreted'}.get(
+                        compiled, 'failed: %s' % compiled)))
+            sys.stderr.write("compile time %.3f seconds\n"
+                             % interpreter.compile_time)
+
+        if opts.memo_stats:
+            for name, stats in interpreter.memo_stats().items():
+                sys.stderr.write("%-16s %8d hits %8d misses %8d evictions\n"
+                                 % (name, stats['hits'], stats['misses'],
+                                    stats['evictions']))
+
+        if profile:
+            if opts.profile:
+                interpreter.profile.print_summary()
+            if opts.profile_json:
+                interpreter.profile.dump_json(opts.profile_json)
+            if opts.profile_pstats:
+                interpreter.profile.dump_stats(opts.profile_pstats)
+
 if __name__ == '__main__':
     main()
@@ -170,6 +170,15 @@ To start, your SSA code should only contain the following operators:
 In this code the word "type" is replaced by an appropriate low-level type
 such as "int" or "float".
 
+Loads and stores also carry the scope of the variable as determined by
+the checker (the is_global attribute of its declaration), so that code
+generators never have to search for a name at run time:
+
+       ('load_local_type', varname, target)
+       ('load_global_type', varname, target)
+       ('store_local_type', source, varname)
+       ('store_global_type', source, varname)
+
 A Word About Correctness
 ========================
 In writing your code, you can assume that the input program is fully
@@ -355,12 +364,25 @@ class GenerateCode(ast.NodeVisitor):
         inst = ('print_' + node.expr.type.name, node.expr.gen_location)
         self.code.append(inst)
 
+    def scope(self, decl):
+        '''
+        Return the scope part of a load/store opcode for a declaration
+        '''
+        return 'global_' if decl.is_global else 'local_'
+
     def visit_LoadVariable(self, node):
         """
-        ('load_type', varname, target)
+        ('load_scope_type', varname, target)
+
+        Constants with a value known at compile time are literals.
         """
         target = self.new_temp(node.type)
-        opcode = 'load_' + node.type.name
+        if getattr(node.symbol, 'value', None) is not None:
+            inst = ('literal_' + node.type.name, node.symbol.value, target)
+            self.code.append(inst)
+            node.gen_location = target
+            return
+        opcode = 'load_' + self.scope(node.symbol) + node.type.name
         inst = (opcode, node.name, target)
         self.code.append(inst)
         node.gen_location = target
@@ -381,13 +403,21 @@ class GenerateCode(ast.NodeVisitor):
         """
         ('alloc_type',varname)
         ('store_type',source, varname)
+
+        Nothing is needed for a constant whose value is known at compile
+        time, since every use of it is a literal.
         """
         # print('visit_ConstantDeclaration')
-        opcode = 'global_' + node.type.name
+        if node.value is not None:
+            return
+        if not node.is_global:
+            opcode = 'alloc_' + node.type.name
+        else:
+            opcode = 'global_' + node.type.name
         inst = (opcode, node.name)
         self.code.append(inst)
         self.visit(node.expr)
-        opcode = 'store_' + node.type.name
+        opcode = 'store_' + self.scope(node) + node.type.name
         inst = (opcode, node.expr.gen_location, node.name)
         self.code.append(inst)
 
@@ -405,7 +435,7 @@ class GenerateCode(ast.NodeVisitor):
         self.code.append(inst)
         if node.expr:
             self.visit(node.expr)
-            opcode = 'store_' + node.type.name
+            opcode = 'store_' + self.scope(node) + node.type.name
             inst = (opcode, node.expr.gen_location, node.name)
             self.code.append(inst)
 
@@ -418,10 +448,10 @@ class GenerateCode(ast.NodeVisitor):
 
     def visit_StoreVariable(self, node):
         """
-        ('store_type',source, varname)
+        ('store_scope_type',source, varname)
         """
         # print('visit_StoreVariable')
-        opcode = 'store_' + node.type.name
+        opcode = 'store_' + self.scope(node.symbol) + node.type.name
         inst = (opcode, node.expr.gen_location, node.name)
         self.code.append(inst)
 
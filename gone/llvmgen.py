@@ -22,7 +22,12 @@ from llvmlite.ir import (
     GlobalVariable, FunctionType
 )
 
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
 from .bblock import BlockVisitor
+from .purity import CollectInstructions, function_instructions
 # Declare the LLVM type objects that you want to use for the low-level
 # in our intermediate code.  Basically, you're going to need to
 # declare the integer, float, and string types here.  These correspond
@@ -49,6 +54,44 @@ typemap = {
     'void': void_type
 }
 
+# Types of the elements of the arrays array kernels work on.  Bools are
+# stored in bytes, like NumPy does.
+index_type = IntType(64)
+element_typemap = {
+    'int': int_type,
+    'float': float_type,
+    'bool': IntType(8),
+}
+
+
+def symbol_name(name):
+    '''
+    Return the LLVM name of a Gone function.  main() is renamed
+    _gone_main() so that it does not clash with the C main() of the
+    runtime.
+    '''
+    return '_gone_main' if name == 'main' else name
+
+
+# Fast-math flags that can be put on float instructions (see
+# fastmath_flags()).  'fast' implies all of the others.
+fastmath_names = ('fast', 'reassoc', 'contract', 'nnan', 'ninf', 'nsz',
+                  'arcp', 'afn')
+
+
+def fastmath_flags(spec):
+    '''
+    Turn a comma separated list of fast-math flags, such as
+    'reassoc,contract', into a tuple for GenerateLLVM
+    '''
+    flags = tuple(name.strip() for name in spec.split(',') if name.strip())
+    for name in flags:
+        if name not in fastmath_names:
+            raise ValueError("Unknown fast-math flag %r (expected one of %s)"
+                             % (name, ', '.join(fastmath_names)))
+    return flags
+
+
 # The following class is going to generate the LLVM instruction stream.
 # The basic features of this class are going to mirror the experiments
 # you tried in Exercise 5.  The execution model is somewhat similar
@@ -78,7 +121,7 @@ typemap = {
 
 class GenerateLLVM(object):
 
-    def __init__(self, name='module'):
+    def __init__(self, name='module', fastmath=()):
         # Perform the basic LLVM initialization.  You need the following parts:
         #
         #    1.  A top-level Module object
@@ -131,6 +174,9 @@ class GenerateLLVM(object):
 
         self.last_branch = None
 
+        # Fast-math flags of the float instructions (see fastmath_flags())
+        self.fastmath = tuple(fastmath)
+
     def start_function(self, name, rettypename, parmtypenames):
         rettype = typemap[rettypename]
         parmtypes = [typemap[pname] for pname in parmtypenames]
@@ -141,9 +187,14 @@ class GenerateLLVM(object):
         # Function.new(self.module, func_type, name)
         self.function = Function(self.module, func_type, name=name)
 
-        # Make the builder and entry block
-        self.block = self.function.append_basic_block("entry")
+        # Make the entry block, which holds the stack allocations of the
+        # local variables, and the builder and block of the function body
+        entry = self.function.append_basic_block("entry")
+        self.block = self.function.append_basic_block("body")
         self.builder = IRBuilder(self.block)
+        self.alloca_builder = IRBuilder(entry)
+        self.alloca_builder.position_before(
+            self.alloca_builder.branch(self.block))
 
         # Make the exit block
         self.exit_block = self.function.append_basic_block("exit")
@@ -154,11 +205,21 @@ class GenerateLLVM(object):
 
         # Make the return variable
         if rettype is not void_type:
-            self.locals['return'] = self.builder.alloca(rettype, name="return")
+            self.start_return(rettype)
 
         # Put an entry in the globals
         self.globals[name] = self.function
 
+    def start_return(self, rettype):
+        self.locals['return'] = self.alloca(rettype, "return")
+
+    def alloca(self, vartype, name):
+        '''
+        Allocate a local variable in the entry block, where LLVM's
+        mem2reg pass can promote it to a register
+        '''
+        return self.alloca_builder.alloca(vartype, name=name)
+
     def new_basic_block(self, name=''):
         self.builder = IRBuilder(self.block.instructions)
         return self.function.append_basic_block(name)
@@ -218,6 +279,58 @@ class GenerateLLVM(object):
         else:
             self.builder.ret_void()
 
+    def generate_array_kernel(self, func):
+        '''
+        Generate a function <name>__array(args..., out, n) calling the
+        already generated function of an ircode.Function for the n
+        elements of the arrays args and storing the results in the
+        array out.  The arrays do not overlap, so LLVM can vectorize
+        the loop when the function is inlined.
+        '''
+        types = [func.return_type] + list(func.parameters)
+        if not all(typename in element_typemap for typename in types):
+            raise RuntimeError("No array kernel for %s: only int, float and "
+                               "bool functions are supported" % func.name)
+        scalar = self.globals[symbol_name(func.name)]
+        parmtypes = [element_typemap[t].as_pointer() for t in func.parameters]
+        rettype = element_typemap[func.return_type].as_pointer()
+        kernel = Function(self.module,
+                          FunctionType(void_type,
+                                       parmtypes + [rettype, index_type]),
+                          name=func.name + '__array')
+        for arg in kernel.args[:-1]:
+            arg.add_attribute('noalias')
+        count = kernel.args[-1]
+
+        entry = kernel.append_basic_block('entry')
+        loop = kernel.append_basic_block('loop')
+        done = kernel.append_basic_block('done')
+        builder = IRBuilder(entry)
+        builder.cbranch(builder.icmp_signed('>', count,
+                                            Constant(index_type, 0)),
+                        loop, done)
+
+        builder.position_at_end(loop)
+        index = builder.phi(index_type, 'i')
+        index.add_incoming(Constant(index_type, 0), entry)
+        argvals = []
+        for typename, array in zip(func.parameters, kernel.args):
+            value = builder.load(builder.gep(array, [index]))
+            if typename == 'bool':
+                value = builder.trunc(value, bool_type)
+            argvals.append(value)
+        result = builder.call(scalar, argvals)
+        if func.return_type == 'bool':
+            result = builder.zext(result, element_typemap['bool'])
+        builder.store(result, builder.gep(kernel.args[-2], [index]))
+        following = builder.add(index, Constant(index_type, 1), 'i.next')
+        index.add_incoming(following, loop)
+        builder.cbranch(builder.icmp_signed('<', following, count), loop, done)
+
+        builder.position_at_end(done)
+        builder.ret_void()
+        return kernel
+
     def add_block(self, name):
         # Add a new block to the existing function
         return self.function.append_basic_block(name)
@@ -252,21 +365,22 @@ class GenerateLLVM(object):
     # def emit_literal_string(self, value, target):
     #     self.temps[target] = Constant(string_type, value)
 
-    # Allocation of variables.  Declare as global variables and set to
-    # a sensible initial value.
+    # Allocation of local variables.  The stack slot is allocated in the
+    # entry block and set to a sensible initial value where the variable
+    # is declared.
     def emit_alloc_int(self, name):
-        var = self.builder.alloca(int_type, name=name)
-        var.initializer = Constant(int_type, 0)
+        var = self.alloca(int_type, name)
+        self.builder.store(Constant(int_type, 0), var)
         self.locals[name] = var
 
     def emit_alloc_float(self, name):
-        var = self.builder.alloca(float_type, name=name)
-        var.initializer = Constant(float_type, 0)
+        var = self.alloca(float_type, name)
+        self.builder.store(Constant(float_type, 0), var)
         self.locals[name] = var
 
     def emit_alloc_bool(self, name):
-        var = self.builder.alloca(bool_type, name=name)
-        var.initializer = Constant(bool_type, 0)
+        var = self.alloca(bool_type, name)
+        self.builder.store(Constant(bool_type, 0), var)
         self.locals[name] = var
 
     def emit_global_int(self, name):
@@ -290,34 +404,32 @@ class GenerateLLVM(object):
     #     self.vars[name] = var
 
     # Load/store instructions for variables.  Load needs to pull a
-    # value from a global variable and store in a temporary. Store
-    # goes in the opposite direction.
-    def lookup_var(self, name):
-        if name in self.locals:
-            return self.locals[name]
-        else:
-            return self.globals[name]
+    # value from a local or global variable and store in a temporary.
+    # Store goes in the opposite direction.  The scope of the variable
+    # is part of the opcode.
+    def emit_load_local_int(self, name, target):
+        self.temps[target] = self.builder.load(self.locals[name], target)
+
+    emit_load_local_float = emit_load_local_int
+    emit_load_local_bool = emit_load_local_int
 
-    def emit_load_int(self, name, target):
-        # print('LOADINT %s, %s' % (name, target))
-        # print('GLOBALS %s' % self.globals)
-        # print('LOCALS %s' % self.locals)
-        self.temps[target] = self.builder.load(self.lookup_var(name), target)
+    def emit_load_global_int(self, name, target):
+        self.temps[target] = self.builder.load(self.globals[name], target)
 
-    def emit_load_float(self, name, target):
-        self.temps[target] = self.builder.load(self.lookup_var(name), target)
+    emit_load_global_float = emit_load_global_int
+    emit_load_global_bool = emit_load_global_int
 
-    def emit_load_bool(self, name, target):
-        self.temps[target] = self.builder.load(self.lookup_var(name), target)
+    def emit_store_local_int(self, source, target):
+        self.builder.store(self.temps[source], self.locals[target])
 
-    def emit_store_int(self, source, target):
-        self.builder.store(self.temps[source], self.lookup_var(target))
+    emit_store_local_float = emit_store_local_int
+    emit_store_local_bool = emit_store_local_int
 
-    def emit_store_float(self, source, target):
-        self.builder.store(self.temps[source], self.lookup_var(target))
+    def emit_store_global_int(self, source, target):
+        self.builder.store(self.temps[source], self.globals[target])
 
-    def emit_store_bool(self, source, target):
-        self.builder.store(self.temps[source], self.lookup_var(target))
+    emit_store_global_float = emit_store_global_int
+    emit_store_global_bool = emit_store_global_int
 
     # Binary + operator
     def emit_add_int(self, left, right, target):
@@ -326,7 +438,8 @@ class GenerateLLVM(object):
 
     def emit_add_float(self, left, right, target):
         self.temps[target] = self.builder.fadd(
-            self.temps[left], self.temps[right], target)
+            self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary - operator
     def emit_sub_int(self, left, right, target):
@@ -335,7 +448,8 @@ class GenerateLLVM(object):
 
     def emit_sub_float(self, left, right, target):
         self.temps[target] = self.builder.fsub(
-            self.temps[left], self.temps[right], target)
+            self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary * operator
     def emit_mul_int(self, left, right, target):
@@ -344,7 +458,8 @@ class GenerateLLVM(object):
 
     def emit_mul_float(self, left, right, target):
         self.temps[target] = self.builder.fmul(
-            self.temps[left], self.temps[right], target)
+            self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary / operator
     def emit_div_int(self, left, right, target):
@@ -353,7 +468,8 @@ class GenerateLLVM(object):
 
     def emit_div_float(self, left, right, target):
         self.temps[target] = self.builder.fdiv(
-            self.temps[left], self.temps[right], target)
+            self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Unary + operator
     def emit_uadd_int(self, source, target):
@@ -366,7 +482,8 @@ class GenerateLLVM(object):
         self.temps[target] = self.builder.fadd(
             Constant(float_type, 0.0),
             self.temps[source],
-            target)
+            target,
+            flags=self.fastmath)
 
     # Unary - operator
     def emit_usub_int(self, source, target):
@@ -379,7 +496,8 @@ class GenerateLLVM(object):
         self.temps[target] = self.builder.fsub(
             Constant(float_type, 0.0),
             self.temps[source],
-            target)
+            target,
+            flags=self.fastmath)
 
     # Binary < operator
     def emit_lt_int(self, left, right, target):
@@ -388,7 +506,8 @@ class GenerateLLVM(object):
 
     def emit_lt_float(self, left, right, target):
         self.temps[target] = self.builder.fcmp_ordered(
-            '<', self.temps[left], self.temps[right], target)
+            '<', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary <= operator
     def emit_le_int(self, left, right, target):
@@ -397,7 +516,8 @@ class GenerateLLVM(object):
 
     def emit_le_float(self, left, right, target):
         self.temps[target] = self.builder.fcmp_ordered(
-            '<=', self.temps[left], self.temps[right], target)
+            '<=', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary > operator
     def emit_gt_int(self, left, right, target):
@@ -406,7 +526,8 @@ class GenerateLLVM(object):
 
     def emit_gt_float(self, left, right, target):
         self.temps[target] = self.builder.fcmp_ordered(
-            '>', self.temps[left], self.temps[right], target)
+            '>', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary >= operator
     def emit_ge_int(self, left, right, target):
@@ -415,7 +536,8 @@ class GenerateLLVM(object):
 
     def emit_ge_float(self, left, right, target):
         self.temps[target] = self.builder.fcmp_ordered(
-            '>=', self.temps[left], self.temps[right], target)
+            '>=', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary == operator
     def emit_eq_int(self, left, right, target):
@@ -428,7 +550,8 @@ class GenerateLLVM(object):
 
     def emit_eq_float(self, left, right, target):
         self.temps[target] = self.builder.fcmp_ordered(
-            '==', self.temps[left], self.temps[right], target)
+            '==', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary != operator
     def emit_ne_int(self, left, right, target):
@@ -441,7 +564,8 @@ class GenerateLLVM(object):
 
     def emit_ne_float(self, left, right, target):
         self.temps[target] = self.builder.fcmp_ordered(
-            '!=', self.temps[left], self.temps[right], target)
+            '!=', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
 
     # Binary && operator
     def emit_and_bool(self, left, right, target):
@@ -485,17 +609,17 @@ class GenerateLLVM(object):
 
     # Function parameter declarations.  Must create as local variables
     def emit_parm_int(self, name, num):
-        var = self.builder.alloca(int_type, name=name)
+        var = self.alloca(int_type, name)
         self.builder.store(self.function.args[num], var)
         self.locals[name] = var
 
     def emit_parm_float(self, name, num):
-        var = self.builder.alloca(float_type, name=name)
+        var = self.alloca(float_type, name)
         self.builder.store(self.function.args[num], var)
         self.locals[name] = var
 
     def emit_parm_bool(self, name, num):
-        var = self.builder.alloca(bool_type, name=name)
+        var = self.alloca(bool_type, name)
         self.builder.store(self.function.args[num], var)
         self.locals[name] = var
 
@@ -525,12 +649,8 @@ class GenerateBlocksLLVM(BlockVisitor):
         # print('Block %s' % self.gen.block.__dict__)
 
     def generate_function(self, func):
-        if func.name == 'main':
-            name = '_gone_main'
-        else:
-            name = func.name
-
-        self.gen.start_function(name, func.return_type, func.parameters)
+        self.gen.start_function(symbol_name(func.name), func.return_type,
+                                func.parameters)
         self.visit(func.start_block)
         self.gen.terminate()
         # return self.generator.function
@@ -595,45 +715,609 @@ class GenerateBlocksLLVM(BlockVisitor):
         self.gen.set_block(after_loop)
 
 
+class GenerateSSALLVM(GenerateLLVM):
+    '''
+    Code generator that keeps local variables in registers.  Instead of
+    a stack slot, each local variable has a current value (self.values)
+    that loads use and stores replace.  Every branch records the values
+    at its end for the block branched to, and a block where branches
+    with different values of a variable meet starts with a phi node
+    selecting the value (see merge_values()).  Loop headers get a phi
+    node for the variables assigned in the loop (see start_loop()).
+    Only variables with different values get a phi node, so the code
+    is close to what mem2reg makes of GenerateLLVM's stack slots,
+    without running it.
+    '''
+
+    def start_function(self, name, rettypename, parmtypenames):
+        # The values of the variables at the branches to each block
+        self.incoming = defaultdict(list)
+        self.values = {}
+        super(GenerateSSALLVM, self).start_function(name, rettypename,
+                                                    parmtypenames)
+
+    def start_return(self, rettype):
+        # Functions that end without a return statement return zero
+        self.values['return'] = Constant(rettype, 0)
+
+    def terminate(self):
+        self.branch(self.exit_block)
+
+        # Only the return value is needed at the exit
+        self.incoming[self.exit_block] = [
+            (block, {name: value for name, value in values.items()
+                     if name == 'return'})
+            for block, values in self.incoming[self.exit_block]]
+        self.set_block(self.exit_block)
+        if 'return' in self.values:
+            self.builder.ret(self.values['return'])
+        else:
+            self.builder.ret_void()
+
+    def set_block(self, block):
+        super(GenerateSSALLVM, self).set_block(block)
+        incoming = self.incoming[block]
+        if len(incoming) == 1:
+            self.values = dict(incoming[0][1])
+        elif incoming:
+            self.values = self.merge_values(incoming)
+
+    def merge_values(self, incoming):
+        '''
+        Return the values of the variables at the start of the current
+        block from a list of (block, values) pairs of its predecessors.
+        Variables not defined in every predecessor are out of scope.
+        '''
+        values = {}
+        for name, value in incoming[0][1].items():
+            if not all(name in other for block, other in incoming):
+                continue
+            if all(other[name] is value for block, other in incoming):
+                values[name] = value
+                continue
+            phi = self.builder.phi(value.type, name)
+            for block, other in incoming:
+                phi.add_incoming(other[name], block)
+            values[name] = phi
+        return values
+
+    def start_loop(self, names):
+        '''
+        Make phi nodes at the start of a loop header for the variables
+        in names that are assigned in the loop.  Returns a dict of the
+        phi nodes, which get the values at the end of the loop in
+        end_loop().
+        '''
+        incoming = self.incoming[self.block]
+        if not incoming:
+            return {}
+        phis = {}
+        for name in sorted(names):
+            if name in self.values:
+                phi = self.builder.phi(self.values[name].type, name)
+                phi.add_incoming(self.values[name], incoming[0][0])
+                self.values[name] = phis[name] = phi
+        return phis
+
+    def end_loop(self, header, phis):
+        for block, values in self.incoming[header][1:]:
+            for name, phi in phis.items():
+                phi.add_incoming(values[name], block)
+
+    def cbranch(self, testvar, true_block, false_block):
+        for block in (true_block, false_block):
+            self.incoming[block].append((self.block, dict(self.values)))
+        super(GenerateSSALLVM, self).cbranch(testvar, true_block, false_block)
+
+    def branch(self, next_block):
+        if self.last_branch != self.block:
+            self.incoming[next_block].append((self.block, dict(self.values)))
+        super(GenerateSSALLVM, self).branch(next_block)
+
+    # Local variables and parameters are values
+    def emit_alloc_int(self, name):
+        self.values[name] = Constant(int_type, 0)
+
+    def emit_alloc_float(self, name):
+        self.values[name] = Constant(float_type, 0)
+
+    def emit_alloc_bool(self, name):
+        self.values[name] = Constant(bool_type, 0)
+
+    def emit_parm_int(self, name, num):
+        self.values[name] = self.function.args[num]
+
+    emit_parm_float = emit_parm_int
+    emit_parm_bool = emit_parm_int
+
+    def emit_load_local_int(self, name, target):
+        self.temps[target] = self.values[name]
+
+    emit_load_local_float = emit_load_local_int
+    emit_load_local_bool = emit_load_local_int
+
+    def emit_store_local_int(self, source, target):
+        self.values[target] = self.temps[source]
+
+    emit_store_local_float = emit_store_local_int
+    emit_store_local_bool = emit_store_local_int
+
+    def emit_return_int(self, source):
+        self.values['return'] = self.temps[source]
+        self.branch(self.exit_block)
+
+    emit_return_float = emit_return_int
+    emit_return_bool = emit_return_int
+
+
+class GenerateSSABlocksLLVM(GenerateBlocksLLVM):
+    '''
+    Block visitor for GenerateSSALLVM, which also needs to know the
+    start and end of each loop
+    '''
+
+    def visit_WhileBlock(self, block):
+        test_block = self.gen.add_block("whiletest")
+        self.gen.branch(test_block)
+        self.gen.set_block(test_block)
+
+        # Variables assigned in the test or the body change in the loop
+        collector = CollectInstructions()
+        collector.visit_WhileBlock(block)
+        phis = self.gen.start_loop({
+            instr[2] for instr in collector.instructions
+            if instr[0].startswith('store_local_')})
+        self.gen.generate_code(block)
+
+        loop_block = self.gen.add_block("loop")
+        after_loop = self.gen.add_block("afterloop")
+        self.gen.cbranch(block.testvar, loop_block, after_loop)
+
+        self.gen.set_block(loop_block)
+        self.visit(block.body)
+        self.gen.branch(test_block)
+        self.gen.end_loop(test_block, phis)
+
+        self.gen.set_block(after_loop)
+
+
+class GenerateCheckedLLVM(GenerateSSALLVM):
+    '''
+    Code generator for the tiered interpreter (gone/tiered.py), whose
+    native code must compute what the interpreter would.  Integers are
+    divided rounding down, as in Python, and != of floats is true for
+    NaN.  Where the interpreter's results can not be had in 32 bits or
+    it would raise an exception (integer overflow, division by zero)
+    the int at the address status is set to 1 instead; the functions
+    are pure, so the caller can run the call again in the interpreter.
+    '''
+
+    def __init__(self, name='module', status=0, **kwargs):
+        super(GenerateCheckedLLVM, self).__init__(name, **kwargs)
+        self.status = Constant(IntType(64), status).inttoptr(
+            int_type.as_pointer())
+
+    def fail_if(self, condition):
+        # Set the status when condition is true
+        self.builder.store(
+            self.builder.or_(self.builder.load(self.status),
+                             self.builder.zext(condition, int_type)),
+            self.status)
+
+    def checked(self, operation, left, right, target):
+        result = operation(left, right)
+        self.fail_if(self.builder.extract_value(result, 1))
+        return self.builder.extract_value(result, 0, target)
+
+    def emit_add_int(self, left, right, target):
+        self.temps[target] = self.checked(self.builder.sadd_with_overflow,
+                                          self.temps[left],
+                                          self.temps[right], target)
+
+    def emit_sub_int(self, left, right, target):
+        self.temps[target] = self.checked(self.builder.ssub_with_overflow,
+                                          self.temps[left],
+                                          self.temps[right], target)
+
+    def emit_mul_int(self, left, right, target):
+        self.temps[target] = self.checked(self.builder.smul_with_overflow,
+                                          self.temps[left],
+                                          self.temps[right], target)
+
+    def emit_usub_int(self, source, target):
+        self.temps[target] = self.checked(self.builder.ssub_with_overflow,
+                                          Constant(int_type, 0),
+                                          self.temps[source], target)
+
+    def emit_div_int(self, left, right, target):
+        builder = self.builder
+        dividend, divisor = self.temps[left], self.temps[right]
+        zero = Constant(int_type, 0)
+
+        # Division by zero and -2**31 / -1 would trap
+        invalid = builder.or_(
+            builder.icmp_signed('==', divisor, zero),
+            builder.and_(
+                builder.icmp_signed('==', dividend,
+                                    Constant(int_type, -2 ** 31)),
+                builder.icmp_signed('==', divisor, Constant(int_type, -1))))
+        self.fail_if(invalid)
+        divisor = builder.select(invalid, Constant(int_type, 1), divisor)
+
+        # sdiv truncates; round down when the remainder and the divisor
+        # have different signs
+        quotient = builder.sdiv(dividend, divisor)
+        remainder = builder.srem(dividend, divisor)
+        adjust = builder.and_(
+            builder.icmp_signed('!=', remainder, zero),
+            builder.icmp_signed('<', builder.xor(remainder, divisor), zero))
+        self.temps[target] = builder.sub(quotient,
+                                         builder.zext(adjust, int_type),
+                                         target)
+
+    def emit_div_float(self, left, right, target):
+        self.fail_if(self.builder.fcmp_ordered(
+            '==', self.temps[right], Constant(float_type, 0.0)))
+        super(GenerateCheckedLLVM, self).emit_div_float(left, right, target)
+
+    def emit_ne_float(self, left, right, target):
+        self.temps[target] = self.builder.fcmp_unordered(
+            '!=', self.temps[left], self.temps[right], target,
+            flags=self.fastmath)
+
+
 #######################################################################
 #                      TESTING/MAIN PROGRAM
 #######################################################################
 
 
-def compile_llvm(source):
-    from .ircode import compile_ircode
+def optimize(module, opt_level=2, target_machine=None):
+    '''
+    Run the LLVM optimization pipeline of opt_level (0-3, as the -O
+    option of clang) over a llvmlite.binding module.  -O1 promotes
+    variables to registers and simplifies the code, -O2 adds GVN, LICM,
+    loop unrolling, vectorization and inlining and -O3 inlines more
+    aggressively.  target_machine sets the target of the module and
+    adds its cost model for the vectorizers.
+    '''
+    import llvmlite.binding as llvm
+
+    if opt_level <= 0:
+        return
+    builder = llvm.PassManagerBuilder()
+    builder.opt_level = opt_level
+    builder.loop_vectorize = opt_level >= 2
+    builder.slp_vectorize = opt_level >= 2
+    if opt_level >= 2:
+        builder.inlining_threshold = inlining_thresholds[opt_level]
+
+    if target_machine is not None:
+        module.triple = target_machine.triple
+        module.data_layout = str(target_machine.target_data)
+    module_passes = llvm.create_module_pass_manager()
+    function_passes = llvm.create_function_pass_manager(module)
+    if target_machine is not None:
+        target_machine.add_analysis_passes(module_passes)
+        target_machine.add_analysis_passes(function_passes)
+    builder.populate(function_passes)
+    builder.populate(module_passes)
+
+    function_passes.initialize()
+    for func in module.functions:
+        function_passes.run(func)
+    function_passes.finalize()
+    module_passes.run(module)
+
+
+# Inlining thresholds used by clang for -O2 and -O3
+inlining_thresholds = {
+    2: 225,
+    3: 275,
+}
 
-    # Compile intermediate code
-    # !!! This needs to be changed in Project 7/8
-    functions = compile_ircode(source)
 
+@contextmanager
+def timed(timings, phase):
+    '''
+    Add the time taken by a with block to timings[phase].  timings may
+    be None.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[phase] = (timings.get(phase, 0.0) +
+                              time.perf_counter() - start)
+
+
+def generate_functions(functions, ssa=False, timings=None, arrays=(),
+                       fastmath=(), symbols=None):
+    '''
+    Generate a llvmlite.ir.Module for a list of ircode.Function objects.
+    With ssa, local variables are kept in registers (see
+    GenerateSSALLVM).  The functions named in arrays also get an array
+    kernel (see GenerateLLVM.generate_array_kernel()).  The float
+    instructions get the fast-math flags in fastmath.
+
+    When functions are a part of a program, symbols are the
+    program_symbols() of the whole program; the functions and global
+    variables defined in other parts are declared external.
+    '''
     # Make the low-level code generator
-    generator = GenerateLLVM()
+    generator = (GenerateSSALLVM if ssa else GenerateLLVM)(fastmath=fastmath)
+    if symbols is not None:
+        declare_symbols(generator, functions, symbols)
 
     # Generate low-level code
     # !!! This needs to be changed in Project 7/8
     # generator.generate_code(code)
     # blockgen = GenerateBlocksLLVM(generator).visit(code.start_block)
-    blockgen = GenerateBlocksLLVM(generator)
-    for func in functions:
-        # print('FUNC %s' % func.name)
-        blockgen.generate_function(func)
+    if ssa:
+        blockgen = GenerateSSABlocksLLVM(generator)
+    else:
+        blockgen = GenerateBlocksLLVM(generator)
+    with timed(timings, 'llvmgen'):
+        for func in functions:
+            # print('FUNC %s' % func.name)
+            blockgen.generate_function(func)
+        for func in functions:
+            if func.name in arrays:
+                generator.generate_array_kernel(func)
 
     #  generator.builder.ret_void()
+    return generator.module
+
+
+def program_symbols(functions):
+    '''
+    Return the types of the symbols of a program, a list of
+    ircode.Function objects, as a tuple of two dicts: the return and
+    parameter types of its Gone and extern functions by name, and the
+    types of its global variables by name
+    '''
+    signatures = {}
+    variables = {}
+    for func in functions:
+        signatures[func.name] = (func.return_type, list(func.parameters))
+        for instr in function_instructions(func):
+            if instr[0] == 'extern_func':
+                signatures[instr[1]] = (instr[2], list(instr[3:]))
+            elif instr[0].startswith('global_'):
+                variables[instr[1]] = instr[0].split('_')[-1]
+    return signatures, variables
+
+
+def declare_symbols(generator, functions, symbols):
+    '''
+    Declare the functions and global variables that a list of
+    ircode.Function objects uses but does not define as external
+    symbols of the module of generator
+    '''
+    signatures, variables = symbols
+    defined = set()
+    called = set()
+    used = set()
+    for func in functions:
+        defined.add(func.name)
+        for instr in function_instructions(func):
+            opcode = instr[0]
+            if opcode == 'extern_func' or opcode.startswith('global_'):
+                defined.add(instr[1])
+            elif opcode == 'call_func':
+                called.add(instr[1])
+            elif opcode.startswith('load_global_'):
+                used.add(instr[1])
+            elif opcode.startswith('store_global_'):
+                used.add(instr[2])
+
+    for name in sorted(called - defined):
+        rettypename, parmtypenames = signatures[name]
+        generator.globals[name] = Function(
+            generator.module,
+            FunctionType(typemap[rettypename],
+                         [typemap[t] for t in parmtypenames]),
+            name=symbol_name(name))
+    for name in sorted(used - defined):
+        # A global variable without an initializer is external
+        generator.globals[name] = GlobalVariable(
+            generator.module, typemap[variables[name]], name=name)
+
+
+def partition_functions(functions, count):
+    '''
+    Split a list of ircode.Function objects into at most count lists
+    with about the same number of instructions each.  The functions
+    keep their order within each list.  An empty list of functions
+    (as compile_ircode() returns for source with errors) makes one
+    empty partition.
+    '''
+    if not functions:
+        return [[]]
+    sizes = {func.name: len(function_instructions(func))
+             for func in functions}
+    partitions = [[] for n in range(min(count, len(functions)))]
+    totals = [0] * len(partitions)
+    # Biggest functions first, each to the smallest partition so far
+    for func in sorted(functions, key=lambda func: -sizes[func.name]):
+        smallest = totals.index(min(totals))
+        partitions[smallest].append(func)
+        totals[smallest] += sizes[func.name]
+    order = {func.name: n for n, func in enumerate(functions)}
+    return [sorted(partition, key=lambda func: order[func.name])
+            for partition in partitions if partition]
+
+
+def map_partitions(worker, functions, jobs, *args):
+    '''
+    Split a program into jobs partitions (see partition_functions())
+    and call worker(partition, symbols, *args) for each of them in a
+    pool of jobs processes, where symbols are the program_symbols() of
+    the program.  Returns the results in the order of the partitions.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+
+    partitions = partition_functions(functions, jobs)
+    symbols = program_symbols(functions)
+    if len(partitions) <= 1:
+        return [worker(partition, symbols, *args) for partition in partitions]
+    count = len(partitions)
+    with ProcessPoolExecutor(count) as pool:
+        return list(pool.map(worker, partitions, [symbols] * count,
+                             *[[arg] * count for arg in args]))
+
+
+def partition_bitcode(functions, symbols, opt_level=0, ssa=False, arrays=(),
+                      fastmath=()):
+    '''
+    Generate the code of a partition of a program (see
+    generate_functions()), optimized at opt_level, and return it as
+    LLVM bitcode.  Run in the worker processes of link_partitions().
+    '''
+    module = generate_functions(functions, ssa, arrays=arrays,
+                                fastmath=fastmath, symbols=symbols)
+    return parse_module(module, opt_level).as_bitcode()
+
+
+def link_partitions(functions, jobs, opt_level=0, ssa=False, arrays=(),
+                    fastmath=(), timings=None):
+    '''
+    Compile a list of ircode.Function objects to a
+    llvmlite.binding.ModuleRef like parse_module(generate_functions()),
+    but split into jobs partitions that are generated and optimized at
+    opt_level in parallel worker processes and then linked.  Functions
+    are only inlined within their partition.
+    '''
+    import llvmlite.binding as llvm
+
+    with timed(timings, 'llvmgen'):
+        bitcodes = map_partitions(partition_bitcode, functions, jobs,
+                                  opt_level, ssa, arrays, fastmath)
+    with timed(timings, 'link'):
+        module = llvm.parse_bitcode(bitcodes[0])
+        for bitcode in bitcodes[1:]:
+            module.link_in(llvm.parse_bitcode(bitcode))
+        module.verify()
+    return module
+
+
+def parse_module(module, opt_level=0, timings=None):
+    '''
+    Turn a llvmlite.ir.Module into a verified llvmlite.binding.ModuleRef,
+    optimized at opt_level, which can be passed to gone.run or added to
+    an execution engine without going through text again.  llvmlite.ir
+    only produces text, so it is parsed once here.
+    '''
+    import llvmlite.binding as llvm
+
+    with timed(timings, 'parse'):
+        module = llvm.parse_assembly(str(module))
+        module.verify()
+    if opt_level > 0:
+        with timed(timings, 'optimize'):
+            optimize(module, opt_level)
+    return module
+
+
+def compile_module(source, opt_level=0, ssa=False, timings=None,
+                   fastmath=(), jobs=1):
+    '''
+    Compile Gone source to a llvmlite.binding.ModuleRef (see
+    parse_module()).  With more than one job, the functions are
+    compiled in parallel (see link_partitions()).
+    '''
+    from .ircode import compile_ircode
+    from .errors import errors_reported
+
+    with timed(timings, 'ircode'):
+        functions = compile_ircode(source)
+    if jobs > 1 and not errors_reported():
+        return link_partitions(functions, jobs, opt_level, ssa,
+                               fastmath=fastmath, timings=timings)
+    return parse_module(generate_functions(functions, ssa, timings,
+                                           fastmath=fastmath),
+                        opt_level, timings)
+
+
+def compile_llvm(source, opt_level=0, ssa=False, arrays=(), fastmath=(),
+                 jobs=1):
+    '''
+    Compile Gone source to the text of LLVM IR, optimized at opt_level,
+    in jobs worker processes (see link_partitions())
+    '''
+    from .ircode import compile_ircode
+    from .errors import errors_reported
 
-    return str(generator.module)
+    functions = compile_ircode(source)
+    if jobs > 1 and not errors_reported():
+        return str(link_partitions(functions, jobs, opt_level, ssa, arrays,
+                                   fastmath))
+    module = generate_functions(functions, ssa, arrays=arrays,
+                                fastmath=fastmath)
+    if opt_level > 0:
+        return str(parse_module(module, opt_level))
+    return str(module)
+
+
+def opt_report(llvm_code):
+    '''
+    Optimize LLVM code at every level.  Returns a list of (level,
+    seconds, instructions) tuples.
+    '''
+    import llvmlite.binding as llvm
+
+    report = []
+    for level in range(4):
+        module = llvm.parse_assembly(llvm_code)
+        start = time.perf_counter()
+        optimize(module, level)
+        elapsed = time.perf_counter() - start
+        count = sum(len(list(block.instructions))
+                    for func in module.functions
+                    for block in func.blocks)
+        report.append((level, elapsed, count))
+    return report
 
 
 def main():
+    import argparse
     import sys
 
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: python3 -m gone.llvmgen filename\n")
-        raise SystemExit(1)
-
-    source = open(sys.argv[1]).read()
-    llvm_code = compile_llvm(source)
-    print(llvm_code)
+    parser = argparse.ArgumentParser(prog='python3 -m gone.llvmgen')
+    parser.add_argument('filename')
+    parser.add_argument('-O', dest='opt_level', type=int, default=0,
+                        choices=range(4), help='optimization level')
+    parser.add_argument('--opt-report', action='store_true',
+                        help='report the time taken and instructions left '
+                        'by each optimization level')
+    parser.add_argument('--ssa', action='store_true',
+                        help='keep local variables in registers')
+    parser.add_argument('--array', dest='arrays', action='append',
+                        default=[], metavar='FUNCNAME',
+                        help='also generate an array kernel for a function')
+    parser.add_argument('--fast-math', dest='fastmath', type=fastmath_flags,
+                        default=(), metavar='FLAGS',
+                        help='comma separated fast-math flags of float '
+                        'instructions (%s)' % ', '.join(fastmath_names))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='compile the functions in this many worker '
+                        'processes and link them (default: 1)')
+    opts = parser.parse_args()
+
+    source = open(opts.filename).read()
+    llvm_code = compile_llvm(source, opts.opt_level, opts.ssa, opts.arrays,
+                             opts.fastmath, opts.jobs)
+    if opts.opt_report:
+        import llvmlite.binding as llvm
+        llvm.initialize()
+        llvm.initialize_native_target()
+        report = opt_report(compile_llvm(source, ssa=opts.ssa,
+                                         fastmath=opts.fastmath))
+        for level, seconds, count in report:
+            sys.stderr.write("-O%d %8.3f seconds %8d instructions\n"
+                             % (level, seconds, count))
+    else:
+        print(llvm_code)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,133 @@
+# gone/purity.py
+'''
+Purity Analysis
+===============
+Finds the Gone functions whose result depends only on their arguments
+and which have no side effects.  The calls of such functions can be
+replaced by the value of an earlier call with the same arguments (see
+the --memoize option of gone.interp).
+
+A function is pure when its intermediate code
+
+    - does not print anything (print_*)
+    - does not assign global variables (global_*, store_global_*)
+    - only reads global variables that are assigned in __init alone
+    - only calls pure Gone functions (never extern functions)
+
+and it returns a value.  Global variables assigned by __init are
+treated as fixed once __init has run.  A function that __init calls
+could see them before they are assigned, so if it reads globals it is
+not pure.
+
+To view the pure functions of a program use::
+
+    bash % python3 -m gone.purity someprogram.g
+'''
+
+from .bblock import BlockVisitor
+
+
+class CollectInstructions(BlockVisitor):
+    '''
+    Collects the instructions of all blocks of a function in a list
+    '''
+
+    def __init__(self):
+        self.instructions = []
+
+    def visit_BasicBlock(self, block):
+        self.instructions.extend(block.instructions)
+
+    def visit_IfBlock(self, block):
+        self.visit_BasicBlock(block)
+        self.visit(block.if_branch)
+        self.visit(block.else_branch)
+
+    def visit_WhileBlock(self, block):
+        self.visit_BasicBlock(block)
+        self.visit(block.body)
+
+
+def function_instructions(func):
+    '''
+    Return a list of all instructions of an ircode.Function
+    '''
+    collector = CollectInstructions()
+    collector.visit(func.start_block)
+    return collector.instructions
+
+
+def called_from(name, calls):
+    '''
+    Return the set of functions called directly or indirectly by name
+    '''
+    seen = set()
+    pending = [name]
+    while pending:
+        for callee in calls.get(pending.pop(), ()):
+            if callee not in seen:
+                seen.add(callee)
+                pending.append(callee)
+    return seen
+
+
+def pure_functions(functions):
+    '''
+    Return the set of names of the pure functions in a list of
+    ircode.Function objects.
+    '''
+    code = {func.name: function_instructions(func) for func in functions}
+    calls = {name: {instr[1] for instr in instrs if instr[0] == 'call_func'}
+             for name, instrs in code.items()}
+
+    # Globals assigned somewhere other than __init can change between calls
+    changing = {instr[2] for name, instrs in code.items() if name != '__init'
+                for instr in instrs if instr[0].startswith('store_global_')}
+    early = called_from('__init', calls)
+
+    pure = set()
+    for func in functions:
+        if func.name == '__init' or func.return_type == 'void':
+            continue
+        for instr in code[func.name]:
+            opcode = instr[0]
+            if opcode.startswith(('print_', 'global_', 'store_global_')):
+                break
+            if opcode.startswith('load_global_') and (
+                    instr[1] in changing or func.name in early):
+                break
+            if opcode == 'call_func' and instr[1] not in code:
+                break
+        else:
+            pure.add(func.name)
+
+    # Drop functions calling impure ones until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for name in list(pure):
+            if not calls[name] <= pure:
+                pure.discard(name)
+                changed = True
+    return pure
+
+
+def main():
+    import sys
+    from .ircode import compile_ircode
+    from .errors import errors_reported
+
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: python3 -m gone.purity filename\n")
+        raise SystemExit(1)
+
+    source = open(sys.argv[1]).read()
+    functions = compile_ircode(source)
+    if errors_reported():
+        raise SystemExit(1)
+    pure = pure_functions(functions)
+    for func in functions:
+        print("%-24s %s" % (func.name, 'pure' if func.name in pure else '-'))
+
+if __name__ == '__main__':
+    main()
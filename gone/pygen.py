@@ -0,0 +1,418 @@
+# gone/pygen.py
+'''
+Python Code Generation
+======================
+Translates the intermediate code of each function into the source of
+a Python function which is then compiled with compile()/exec().  The
+structured if/while statements are recovered from the IfBlock and
+WhileBlock graph in gone/bblock.py and temporaries become ordinary
+Python local variables.  Programs therefore run at the speed of CPython
+bytecode instead of one method call per IR instruction.
+
+To view the generated Python code use::
+
+    bash % python3 -m gone.pygen someprogram.g
+
+To run a program with it use::
+
+    bash % python3 -m gone.interp --engine python someprogram.g
+
+Names are prefixed so that Gone identifiers can never clash with
+Python keywords or with each other: local variables become v_name,
+global variables g_name and functions f_name.  Temporaries such as
+__int_3 are used as is.
+'''
+
+from functools import lru_cache
+
+from .bblock import BlockVisitor
+from .interp import Output, find_extern
+
+# Python operators for the binary and unary opcodes.  Opcodes are
+# looked up without their type suffix except where the semantics of
+# the types differ (division).
+binary_ops = {
+    'add': '+',
+    'sub': '-',
+    'mul': '*',
+    'div_int': '//',
+    'div_float': '/',
+    'lt': '<',
+    'le': '<=',
+    'gt': '>',
+    'ge': '>=',
+    'eq': '==',
+    'ne': '!=',
+    'and': 'and',
+    'or': 'or',
+}
+
+unary_ops = {
+    'uadd': '+',
+    'usub': '-',
+    'not': 'not ',
+}
+
+# Initial values of allocated variables
+default_values = {
+    'int': 0,
+    'float': 0.0,
+    'string': '',
+    'bool': False,
+}
+
+
+class GeneratePython(object):
+    '''
+    Generates Python source code from intermediate code tuples.  Like
+    GenerateLLVM in gone/llvmgen.py, each opcode (opcode, args) is
+    dispatched to a method self.emit_opcode(args).
+    '''
+
+    def __init__(self):
+        # Lines of source code for the whole module
+        self.lines = []
+
+        # Lines of the function currently being generated
+        self.body = []
+        self.indent = 1
+
+        # Start positions of the open if/else/while suites
+        self.suites = []
+
+        # Names of the globals assigned by the current function
+        self.assigned_globals = set()
+
+    def start_function(self, name, parmtypenames):
+        self.name = name
+        self.parameters = ['p%d' % n for n in range(len(parmtypenames))]
+        self.assigned_globals = set()
+        self.body = []
+        self.indent = 1
+
+    def end_function(self):
+        self.lines.append('def f_%s(%s):' % (self.name,
+                                             ', '.join(self.parameters)))
+        if self.assigned_globals:
+            self.lines.append('    global ' + ', '.join(
+                sorted(self.assigned_globals)))
+        self.lines.extend(self.body or ['    pass'])
+        self.lines.append('')
+
+    @property
+    def source(self):
+        return '\n'.join(self.lines) + '\n'
+
+    def emit(self, line):
+        self.body.append('    ' * self.indent + line)
+
+    def begin_suite(self, line):
+        self.emit(line)
+        self.indent += 1
+        self.suites.append(len(self.body))
+
+    def end_suite(self):
+        if len(self.body) == self.suites.pop():
+            self.emit('pass')
+        self.indent -= 1
+
+    def store_global(self, name):
+        self.assigned_globals.add('g_' + name)
+        return 'g_' + name
+
+    def generate_code(self, ircode):
+        # Opcodes without an emit_opcode() method are operators found
+        # in the binary_ops and unary_ops tables
+        for opcode, *args in ircode:
+            kind = opcode.rsplit('_', 1)[0]
+            if hasattr(self, 'emit_' + opcode):
+                getattr(self, 'emit_' + opcode)(*args)
+            elif opcode in binary_ops:
+                self.emit_binary(binary_ops[opcode], *args)
+            elif kind in binary_ops:
+                self.emit_binary(binary_ops[kind], *args)
+            elif kind in unary_ops:
+                self.emit_unary(unary_ops[kind], *args)
+            else:
+                print('Warning: No emit_' + opcode + '() method')
+
+    # ----------------------------------------------------------------------
+    # Opcode implementation
+    # ----------------------------------------------------------------------
+
+    def emit_literal_int(self, value, target):
+        self.emit('%s = %r' % (target, value))
+
+    emit_literal_float = emit_literal_int
+    emit_literal_string = emit_literal_int
+    emit_literal_bool = emit_literal_int
+
+    def emit_alloc_int(self, name):
+        self.emit('v_%s = %r' % (name, default_values['int']))
+
+    def emit_alloc_float(self, name):
+        self.emit('v_%s = %r' % (name, default_values['float']))
+
+    def emit_alloc_string(self, name):
+        self.emit('v_%s = %r' % (name, default_values['string']))
+
+    def emit_alloc_bool(self, name):
+        self.emit('v_%s = %r' % (name, default_values['bool']))
+
+    def emit_global_int(self, name):
+        self.emit('%s = %r' % (self.store_global(name),
+                               default_values['int']))
+
+    def emit_global_float(self, name):
+        self.emit('%s = %r' % (self.store_global(name),
+                               default_values['float']))
+
+    def emit_global_string(self, name):
+        self.emit('%s = %r' % (self.store_global(name),
+                               default_values['string']))
+
+    def emit_global_bool(self, name):
+        self.emit('%s = %r' % (self.store_global(name),
+                               default_values['bool']))
+
+    def emit_load_local_int(self, name, target):
+        self.emit('%s = v_%s' % (target, name))
+
+    emit_load_local_float = emit_load_local_int
+    emit_load_local_string = emit_load_local_int
+    emit_load_local_bool = emit_load_local_int
+
+    def emit_load_global_int(self, name, target):
+        self.emit('%s = g_%s' % (target, name))
+
+    emit_load_global_float = emit_load_global_int
+    emit_load_global_string = emit_load_global_int
+    emit_load_global_bool = emit_load_global_int
+
+    def emit_store_local_int(self, source, target):
+        self.emit('v_%s = %s' % (target, source))
+
+    emit_store_local_float = emit_store_local_int
+    emit_store_local_string = emit_store_local_int
+    emit_store_local_bool = emit_store_local_int
+
+    def emit_store_global_int(self, source, target):
+        self.emit('%s = %s' % (self.store_global(target), source))
+
+    emit_store_global_float = emit_store_global_int
+    emit_store_global_string = emit_store_global_int
+    emit_store_global_bool = emit_store_global_int
+
+    def emit_binary(self, op, left, right, target):
+        self.emit('%s = %s %s %s' % (target, left, op, right))
+
+    def emit_unary(self, op, source, target):
+        self.emit('%s = %s%s' % (target, op, source))
+
+    def emit_print_int(self, source):
+        self.emit('_print(%s)' % source)
+
+    emit_print_float = emit_print_int
+    emit_print_string = emit_print_int
+    emit_print_bool = emit_print_int
+
+    def emit_extern_func(self, name, rettypename, *parmtypenames):
+        self.assigned_globals.add('f_' + name)
+        self.emit('f_%s = _extern(%r)' % (name, name))
+
+    def emit_call_func(self, funcname, *args):
+        target = args[-1]
+        self.emit('%s = f_%s(%s)' % (target, funcname, ', '.join(args[:-1])))
+
+    def emit_parm_int(self, name, num):
+        self.emit('v_%s = p%d' % (name, num))
+
+    emit_parm_float = emit_parm_int
+    emit_parm_string = emit_parm_int
+    emit_parm_bool = emit_parm_int
+
+    def emit_return_int(self, source):
+        self.emit('return %s' % source)
+
+    emit_return_float = emit_return_int
+    emit_return_string = emit_return_int
+    emit_return_bool = emit_return_int
+
+    def emit_return_void(self):
+        self.emit('return')
+
+
+class GenerateBlocksPython(BlockVisitor):
+    '''
+    Walks the blocks of each function and turns IfBlock and WhileBlock
+    into Python if and while statements.
+    '''
+
+    def __init__(self, generator):
+        self.gen = generator
+
+    def generate_function(self, func):
+        self.gen.start_function(func.name, func.parameters)
+        self.visit(func.start_block)
+        self.gen.end_function()
+
+    def visit_BasicBlock(self, block):
+        self.gen.generate_code(block.instructions)
+
+    def visit_IfBlock(self, block):
+        self.gen.generate_code(block.instructions)
+        self.gen.begin_suite('if %s:' % block.testvar)
+        self.visit(block.if_branch)
+        self.gen.end_suite()
+        if block.else_branch is not None:
+            self.gen.begin_suite('else:')
+            self.visit(block.else_branch)
+            self.gen.end_suite()
+
+    def visit_WhileBlock(self, block):
+        self.gen.begin_suite('while True:')
+        self.gen.generate_code(block.instructions)
+        self.gen.emit('if not %s:' % block.testvar)
+        self.gen.emit('    break')
+        self.visit(block.body)
+        self.gen.end_suite()
+
+
+def generate_python(functions):
+    '''
+    Generate the Python source code for a list of ircode.Function objects
+    '''
+    generator = GeneratePython()
+    blockgen = GenerateBlocksPython(generator)
+    for func in functions:
+        blockgen.generate_function(func)
+    return generator.source
+
+
+class PythonInterpreter(object):
+    '''
+    Runs Gone programs by compiling every function to Python.  It offers
+    the same register_functions()/execute_function() interface as
+    gone.interp.Interpreter, but takes ircode.Function objects rather
+    than linked code.  Like Interpreter, it raises RuntimeError when
+    calls nest deeper than max_depth.  Gone calls are Python calls, so
+    they can not nest deeper than the Python recursion limit allows
+    either; exceeding it raises the same RuntimeError.  The limit is
+    not raised, since deep recursion through C code (the caches of
+    memoized functions) could then overflow the C stack.
+    '''
+
+    def __init__(self, name="module", max_depth=None, memoize=(),
+                 memo_size=1024, output=None):
+        self.name = name
+
+        # Maximum depth of nested Gone calls and the current depth
+        self.max_depth = max_depth
+        self.depth = 0
+
+        # Where print statements and putchar() write to
+        self.output = output or Output()
+
+        # Names of the pure functions whose results are cached
+        self.memoize = set(memoize)
+        self.memo_size = memo_size
+
+        # Module namespace of the generated code.  Gone globals and
+        # functions are Python globals of this namespace.
+        self.namespace = {
+            '_print': self.output.print_value,
+            '_extern': self.extern,
+        }
+
+    def register_functions(self, functions):
+        self.source = generate_python(functions)
+        code = compile(self.source, '<gone:%s>' % self.name, 'exec')
+        exec(code, self.namespace)
+
+        # Calls go through the module globals, so replacing a function
+        # there also counts and caches its recursive calls.  Cache hits
+        # do not count as calls.
+        if self.max_depth is not None:
+            for func in functions:
+                self.namespace['f_' + func.name] = self.depth_wrapper(
+                    func.name, self.namespace['f_' + func.name])
+        for name in self.memoize:
+            self.namespace['f_' + name] = lru_cache(self.memo_size)(
+                self.namespace['f_' + name])
+
+    def depth_wrapper(self, name, func):
+        '''
+        Make a generated function count the depth of nested calls
+        '''
+        def call(*args):
+            if self.depth >= self.max_depth:
+                raise RuntimeError("Maximum call depth of %d exceeded "
+                                   "calling %s" % (self.max_depth, name))
+            self.depth += 1
+            try:
+                return func(*args)
+            finally:
+                self.depth -= 1
+        return call
+
+    def memo_stats(self):
+        stats = {}
+        for name in sorted(self.memoize):
+            info = self.namespace['f_' + name].cache_info()
+            stats[name] = {
+                'hits': info.hits,
+                'misses': info.misses,
+                'evictions': info.misses - info.currsize,
+                'size': info.currsize,
+                'maxsize': info.maxsize,
+            }
+        return stats
+
+    def execute_function(self, funcname, args):
+        try:
+            return self.namespace['f_' + funcname](*args)
+        except RecursionError as e:
+            raise self.depth_error(e) from None
+
+    def depth_error(self, error):
+        '''
+        Turn a RecursionError into the RuntimeError of Interpreter,
+        naming the depth and the function of the innermost Gone call in
+        its traceback
+        '''
+        depth = 0
+        name = None
+        tb = error.__traceback__
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            if code.co_filename == '<gone:%s>' % self.name:
+                depth += 1
+                name = code.co_name[2:]
+            tb = tb.tb_next
+        return RuntimeError("Maximum call depth of %d exceeded calling %s"
+                            % (depth, name))
+
+    def extern(self, name):
+        '''
+        Find an extern function (see interp.find_extern()).  putchar()
+        writes to self.output.
+        '''
+        if name == 'putchar':
+            return self.output.putchar
+        return find_extern(name)
+
+
+def main():
+    import sys
+    from .ircode import compile_ircode
+
+    if len(sys.argv) != 2:
+        sys.stderr.write("Usage: python3 -m gone.pygen filename\n")
+        raise SystemExit(1)
+
+    source = open(sys.argv[1]).read()
+    functions = compile_ircode(source)
+    print(generate_python(functions))
+
+if __name__ == '__main__':
+    main()
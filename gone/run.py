@@ -8,28 +8,584 @@
 #
 # Note:  This project will require minor modification in Project 8
 
+import os
 import os.path
 import ctypes
+import hashlib
+import tempfile
 import llvmlite.binding as llvm
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .llvmgen import optimize, symbol_name, timed
+
 _path = os.path.dirname(__file__)
 
+# ctypes types of the Gone types native functions can take and return
+ctypes_types = {
+    'int': ctypes.c_int,
+    'float': ctypes.c_double,
+    'bool': ctypes.c_bool,
+    'void': None,
+}
 
-def run(llvm_ir):
-    # Load the runtime
-    ctypes._dlopen(os.path.join(_path, 'gonert.so'), ctypes.RTLD_GLOBAL)
+# NumPy element types of the arrays of array kernels
+dtypes = {
+    'int': 'int32',
+    'float': 'float64',
+    'bool': 'bool',
+}
+
+# Default directory of the object cache
+default_cache_dir = os.environ.get(
+    'GONE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'gone'))
+
+
+def code_key(code, target_machine, opt_level, host_cpu=False):
+    '''
+    Return a hash of code (LLVM IR text or bitcode) compiled for
+    target_machine at opt_level, for the host CPU or not (see
+    create_target_machine())
+    '''
+    digest = hashlib.sha256()
+    for part in (code, target_machine.triple, llvm.get_host_cpu_name(),
+                 llvm.get_host_cpu_features().flatten(), str(opt_level),
+                 'host' if host_cpu else 'generic'):
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class ObjectCache(object):
+    '''
+    On-disk cache of the machine code MCJIT compiles, so that running
+    an unchanged program again skips optimization and code generation.
+    Entries are keyed on a hash of the LLVM IR, the target (triple, CPU
+    and features) and the optimization level.  When the files in the
+    cache take more than max_size bytes, the least recently used ones
+    are removed.
+    '''
+
+    def __init__(self, directory=None, max_size=64 * 1024 * 1024):
+        self.directory = directory or default_cache_dir
+        self.max_size = max_size
+
+        # Keys and cached code of the modules an engine will compile
+        self.pending = {}
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def key(self, code, target_machine, opt_level, host_cpu=False):
+        return code_key(code, target_machine, opt_level, host_cpu)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.o')
+
+    def load(self, key):
+        '''
+        Return the object code cached under key, or None
+        '''
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+            # The modification time orders the entries for eviction
+            os.utime(self.path(key))
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def store(self, key, data):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmpname, self.path(key))
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in
+        max_size bytes
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.o'):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+    def attach(self, engine):
+        engine.set_object_cache(self.notify, self.getbuffer)
+
+    def expect(self, module, key, data):
+        '''
+        Record the key and cached object code (or None) of a module
+        that an engine this cache is attached to will compile
+        '''
+        self.pending[module] = (key, data)
+
+    def forget(self, module):
+        '''
+        Drop the record of a module made by expect()
+        '''
+        self.pending.pop(module, None)
+
+    # Hooks called by MCJIT
+    def getbuffer(self, module):
+        key, data = self.pending.get(module, (None, None))
+        return data
 
-    # Initialize LLVM
+    def notify(self, module, data):
+        key, cached = self.pending.get(module, (None, None))
+        if key is not None and cached is None:
+            try:
+                self.store(key, data)
+            except OSError:
+                # Caching is an optimization, it must not stop a run
+                pass
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'directory': self.directory,
+        }
+
+
+_initialized = False
+_runtime_loaded = False
+
+
+def initialize_llvm():
+    '''
+    Initialize LLVM, once per process
+    '''
+    global _initialized
+    if _initialized:
+        return
     llvm.initialize()
     llvm.initialize_native_target()
     llvm.initialize_native_asmprinter()
+    _initialized = True
+
+
+def load_runtime():
+    '''
+    Load the runtime (gonert.so) that the code of Gone programs calls,
+    once per process
+    '''
+    global _runtime_loaded
+    if _runtime_loaded:
+        return
+    ctypes._dlopen(os.path.join(_path, 'gonert.so'), ctypes.RTLD_GLOBAL)
+    _runtime_loaded = True
+
+
+def host_cpu_options():
+    '''
+    Return the cpu and features arguments of
+    Target.create_target_machine() for the CPU LLVM runs on, so the
+    code can use all its instructions (AVX2, AVX-512 and so on)
+    '''
+    return {
+        'cpu': llvm.get_host_cpu_name(),
+        'features': llvm.get_host_cpu_features().flatten(),
+    }
 
+
+def create_target_machine(opt_level=0, host_cpu=False, reloc='default'):
+    '''
+    Create a target machine for the default triple.  The code is
+    generated for a generic CPU of the triple, or with host_cpu for the
+    host CPU (see host_cpu_options()), with the relocation model reloc.
+    '''
+    initialize_llvm()
     target = llvm.Target.from_default_triple()
-    target_machine = target.create_target_machine()
-    mod = llvm.parse_assembly(llvm_ir)
-    mod.verify()
+    options = host_cpu_options() if host_cpu else {}
+    return target.create_target_machine(opt=opt_level, reloc=reloc,
+                                        **options)
+
+
+def create_engine(llvm_ir='', opt_level=0, cache=None, timings=None,
+                  host_cpu=False, runtime=True):
+    '''
+    Load the runtime, initialize LLVM and create an MCJIT execution
+    engine for a module, optimized at opt_level (0-3).  The module is
+    either the text of LLVM IR or an unoptimized llvmlite.binding
+    ModuleRef (see llvmgen.compile_module()), which is used as it is.
+    More modules can be added to the engine later with
+    engine.add_module().  With an ObjectCache, code compiled before for
+    the same IR is loaded from the cache instead.  The time of each
+    phase is added to the timings dict, if given.  With host_cpu, the
+    code is generated for the host CPU.  Code that does not call the
+    runtime (print or the builtins of gonert.c) can be run without it
+    by passing runtime=False.
+    '''
+    if runtime:
+        load_runtime()
+    target_machine = create_target_machine(opt_level, host_cpu)
+    if isinstance(llvm_ir, llvm.ModuleRef):
+        mod = llvm_ir
+    else:
+        with timed(timings, 'parse'):
+            mod = llvm.parse_assembly(llvm_ir)
+            mod.verify()
+
+    key = data = None
+    if cache is not None:
+        with timed(timings, 'cache'):
+            code = llvm_ir if mod is not llvm_ir else mod.as_bitcode()
+            key = cache.key(code, target_machine, opt_level, host_cpu)
+            data = cache.load(key)
+    if data is None:
+        with timed(timings, 'optimize'):
+            optimize(mod, opt_level, target_machine)
 
     engine = llvm.create_mcjit_compiler(mod, target_machine)
+    if cache is not None:
+        cache.attach(engine)
+        cache.expect(mod, key, data)
+    return engine
+
+
+class JITProgram(object):
+    '''
+    A program loaded into a JITSession.  Its symbols are renamed with a
+    prefix made from a hash of its code, so any number of programs with
+    the same function and global names can be loaded at once.
+    '''
+
+    def __init__(self, prefix, module, key):
+        self.prefix = prefix
+        self.module = module
+        self.key = key
+
+        # Size of the object code in bytes
+        self.size = 0
+
+        # Number of JITSession.add() calls not matched by remove()
+        self.refs = 0
+
+        # ctypes functions by name (see JITSession.function())
+        self.functions = {}
+
+    def symbol(self, name):
+        return self.prefix + symbol_name(name)
+
+
+class JITSession(object):
+    '''
+    Long lived MCJIT engine that runs many programs.  LLVM, the target
+    machine and the runtime are set up once.  Programs are added with
+    add(), run with run() as often as needed and removed with remove().
+    Adding a program that is already loaded reuses it.
+
+    The size of the object code of every loaded program is tracked
+    (see stats()).  MCJIT keeps the code of removed programs allocated
+    until the session is closed, which is counted as retained; long
+    running users should start a new session when it grows too large.
+
+    With host_cpu, the code is generated for the host CPU.
+    '''
+
+    def __init__(self, opt_level=0, cache=None, host_cpu=False):
+        self.opt_level = opt_level
+        self.cache = cache
+        self.host_cpu = host_cpu
+        load_runtime()
+        self.target_machine = create_target_machine(opt_level, host_cpu)
+        self.engine = llvm.create_mcjit_compiler(llvm.parse_assembly(''),
+                                                 self.target_machine)
+        self.engine.set_object_cache(self.notify, self.getbuffer)
+
+        # Loaded programs by prefix and by module
+        self.programs = {}
+        self.modules = {}
+
+        # Statistics
+        self.runs = 0
+        self.retained = 0
+
+    def add(self, llvm_ir, timings=None, optimized=False):
+        '''
+        Load a program, given as LLVM IR text or an unoptimized
+        llvmlite.binding ModuleRef (which the session takes over), and
+        return its JITProgram.  With optimized, the module is already
+        optimized at the session's opt_level (see
+        llvmgen.link_partitions()) and is not optimized again.
+        '''
+        if isinstance(llvm_ir, llvm.ModuleRef):
+            mod = llvm_ir
+        else:
+            with timed(timings, 'parse'):
+                mod = llvm.parse_assembly(llvm_ir)
+                mod.verify()
+        digest = code_key(mod.as_bitcode(), self.target_machine,
+                          self.opt_level, self.host_cpu)
+        prefix = '_g%s_' % digest[:16]
+        program = self.programs.get(prefix)
+        if program is None:
+            for value in list(mod.functions) + list(mod.global_variables):
+                if not value.is_declaration:
+                    value.name = prefix + value.name
+            # Cached code has the symbols renamed as well
+            program = JITProgram(prefix, mod, code_key(
+                mod.as_bitcode(), self.target_machine, self.opt_level,
+                self.host_cpu))
+            cached = None
+            if self.cache is not None:
+                with timed(timings, 'cache'):
+                    cached = self.cache.load(program.key)
+                self.cache.expect(mod, program.key, cached)
+            if cached is None and not optimized:
+                with timed(timings, 'optimize'):
+                    optimize(mod, self.opt_level, self.target_machine)
+            self.programs[prefix] = self.modules[mod] = program
+            with timed(timings, 'codegen'):
+                self.engine.add_module(mod)
+                self.engine.finalize_object()
+        program.refs += 1
+        return program
+
+    def remove(self, program):
+        '''
+        Undo an add() of a program, unloading it when it is no longer
+        used
+        '''
+        program.refs -= 1
+        if program.refs > 0:
+            return
+        del self.programs[program.prefix]
+        del self.modules[program.module]
+        if self.cache is not None:
+            self.cache.forget(program.module)
+        self.engine.remove_module(program.module)
+        program.module.close()
+        self.retained += program.size
+
+    def address(self, program, name):
+        '''
+        Return the address of a function of a loaded program
+        '''
+        address = self.engine.get_function_address(program.symbol(name))
+        if not address:
+            raise RuntimeError("No function %s found" % name)
+        return address
+
+    def function(self, program, func):
+        '''
+        Return a ctypes function calling the native code of an
+        ircode.Function of a loaded program
+        '''
+        if func.name not in program.functions:
+            types = [func.return_type] + list(func.parameters)
+            for n, typename in enumerate(types):
+                if typename not in ctypes_types or (n and typename == 'void'):
+                    raise RuntimeError("%s of type %s can not be called from "
+                                       "Python" % (func.name, typename))
+            prototype = ctypes.CFUNCTYPE(*[ctypes_types[t] for t in types])
+            program.functions[func.name] = prototype(
+                self.address(program, func.name))
+        return program.functions[func.name]
+
+    def run(self, program, timings=None):
+        '''
+        Run __init() and main() of a program and return the result
+        '''
+        init_func = ctypes.CFUNCTYPE(None)(self.address(program, '__init'))
+        main_func = ctypes.CFUNCTYPE(ctypes.c_int)(
+            self.address(program, 'main'))
+        self.runs += 1
+        with timed(timings, 'run'):
+            init_func()
+            return main_func()
+
+    def close(self):
+        if self.cache is not None:
+            for module in self.modules:
+                self.cache.forget(module)
+        self.engine.close()
+        self.programs.clear()
+        self.modules.clear()
+
+    # Hooks called by MCJIT.  They record the size of the object code
+    # and leave caching to the ObjectCache.
+    def getbuffer(self, module):
+        program = self.modules.get(module)
+        if program is None or self.cache is None:
+            return None
+        data = self.cache.getbuffer(module)
+        if data is not None:
+            program.size = len(data)
+        return data
+
+    def notify(self, module, data):
+        program = self.modules.get(module)
+        if program is None:
+            return
+        program.size = len(data)
+        if self.cache is not None:
+            self.cache.notify(module, data)
+
+    def stats(self):
+        return {
+            'programs': len(self.programs),
+            'runs': self.runs,
+            'code_size': sum(program.size
+                             for program in self.programs.values()),
+            'retained': self.retained,
+        }
+
+
+class ArrayKernel(object):
+    '''
+    Calls the array kernel of a Gone function (see
+    llvmgen.GenerateLLVM.generate_array_kernel()) on NumPy arrays, like
+    a ufunc.  The arguments are broadcast against each other.  Arrays
+    that are contiguous and of the right type are passed without
+    copying, as is out, which must be such an array of the result's
+    shape.
+    '''
+
+    def __init__(self, address, return_type, parameters):
+        if np is None:
+            raise RuntimeError("Array kernels require numpy")
+        self.return_type = return_type
+        self.parameters = parameters
+        self.kernel = ctypes.CFUNCTYPE(
+            None, *[ctypes.c_void_p] * (len(parameters) + 1) +
+            [ctypes.c_int64])(address)
+
+    def __call__(self, *args, out=None):
+        if len(args) != len(self.parameters):
+            raise TypeError("expected %d arguments, got %d"
+                            % (len(self.parameters), len(args)))
+        arrays = np.broadcast_arrays(*[np.asarray(arg) for arg in args])
+        shape = arrays[0].shape if arrays else ()
+        arrays = [np.ascontiguousarray(array, dtype=dtypes[typename])
+                  for array, typename in zip(arrays, self.parameters)]
+        dtype = np.dtype(dtypes[self.return_type])
+        if out is None:
+            out = np.empty(shape, dtype=dtype)
+        elif (out.shape != shape or out.dtype != dtype or
+                not out.flags.c_contiguous):
+            raise ValueError("out must be a contiguous %s array of shape %s"
+                             % (dtype, shape))
+        self.kernel(*[array.ctypes.data for array in arrays + [out]] +
+                    [out.size])
+        return out
+
+
+class GoneFunctions(object):
+    '''
+    The functions of a Gone program loaded by load(), as attributes
+    holding ctypes functions that call the native code.  Functions
+    whose types ctypes can not handle are left out.  Functions with an
+    array kernel have it as their array attribute.
+    '''
+
+    def __init__(self, session, program, functions, arrays=()):
+        self._session = session
+        self._program = program
+        self._signatures = {}
+        for func in functions:
+            if func.name == '__init':
+                continue
+            try:
+                function = session.function(program, func)
+            except RuntimeError:
+                continue
+            if func.name in arrays and not hasattr(function, 'array'):
+                function.array = ArrayKernel(
+                    session.address(program, func.name + '__array'),
+                    func.return_type, func.parameters)
+            setattr(self, func.name, function)
+            self._signatures[func.name] = (func.return_type, func.parameters)
+
+    def __repr__(self):
+        return '<GoneFunctions %s>' % ', '.join(
+            '%s(%s) %s' % (name, ', '.join(parameters), return_type)
+            for name, (return_type, parameters)
+            in sorted(self._signatures.items()))
+
+    def close(self):
+        '''
+        Unload the program.  Its functions must not be called anymore.
+        '''
+        self._session.remove(self._program)
+
+
+# Sessions used by load() by optimization level and host_cpu
+_sessions = {}
+
+
+def load(source, opt_level=2, ssa=True, session=None, cache=None,
+         arrays=(), host_cpu=False, fastmath=(), jobs=1):
+    '''
+    Compile Gone source in a JITSession (by default one shared by all
+    calls with the same opt_level and host_cpu) and return its functions
+    as a GoneFunctions object.  __init() is run first, so the functions
+    see the global variables initialized.  The functions named in arrays
+    can also be called on NumPy arrays.  The float instructions get the
+    fast-math flags in fastmath (see llvmgen.fastmath_flags()).  With
+    more than one job, the functions are compiled in parallel (see
+    llvmgen.link_partitions()).  For example::
+
+        funcs = load(open('Programs/mandel.g').read(),
+                     arrays=['in_mandelbrot'])
+        funcs.in_mandelbrot(0.0, 0.0, 1000)     # -> True
+        funcs.in_mandelbrot.array(xs, ys, 1000)
+    '''
+    from .ircode import compile_ircode
+    from .errors import errors_reported, clear_errors
+    from .llvmgen import generate_functions, parse_module, link_partitions
+
+    clear_errors()
+    functions = compile_ircode(source)
+    if errors_reported():
+        raise RuntimeError("%d errors in Gone source" % errors_reported())
+    if session is None:
+        if (opt_level, host_cpu) not in _sessions:
+            _sessions[opt_level, host_cpu] = JITSession(opt_level, cache,
+                                                        host_cpu)
+        session = _sessions[opt_level, host_cpu]
+    if jobs > 1:
+        program = session.add(link_partitions(
+            functions, jobs, session.opt_level, ssa, arrays, fastmath),
+            optimized=True)
+    else:
+        program = session.add(parse_module(generate_functions(
+            functions, ssa, arrays=arrays, fastmath=fastmath)))
+    if program.refs == 1:
+        ctypes.CFUNCTYPE(None)(session.address(program, '__init'))()
+    return GoneFunctions(session, program, functions, arrays)
+
+
+def run(llvm_ir, opt_level=0, cache=None, timings=None, host_cpu=False):
+    engine = create_engine(llvm_ir, opt_level, cache, timings, host_cpu)
+    with timed(timings, 'codegen'):
+        engine.finalize_object()
 
     # Execute the main() function
     #
@@ -39,10 +595,11 @@ def run(llvm_ir):
     # main_func()
     init_ptr = engine.get_function_address('__init')
     init_func = ctypes.CFUNCTYPE(None)(init_ptr)
-    init_func()
-    main_ptr = engine.get_function_address('_gone_main')
+    main_ptr = engine.get_function_address(symbol_name('main'))
     main_func = ctypes.CFUNCTYPE(None)(main_ptr)
-    main_func()
+    with timed(timings, 'run'):
+        init_func()
+        main_func()
 
     # Project 8:  Modify the above code to execute the Gone __init()
     # function that initializes global variables.  Then add code below
@@ -50,18 +607,79 @@ def run(llvm_ir):
 
 
 def main():
-    from .errors import errors_reported
-    from .llvmgen import compile_llvm
+    from .errors import errors_reported, clear_errors
+    from .llvmgen import compile_module, fastmath_flags, fastmath_names
+    import argparse
     import sys
 
-    if len(sys.argv) != 2:
-        sys.stderr.write("Usage: python3 -m gone.run filename\n")
-        raise SystemExit(1)
+    parser = argparse.ArgumentParser(prog='python3 -m gone.run')
+    parser.add_argument('filenames', nargs='+', metavar='filename',
+                        help='programs, run one after the other in one '
+                        'JIT session')
+    parser.add_argument('-O', dest='opt_level', type=int, default=0,
+                        choices=range(4), help='optimization level')
+    parser.add_argument('--ssa', action='store_true',
+                        help='keep local variables in registers')
+    parser.add_argument('--host-cpu', action='store_true',
+                        help='generate code for the CPU of this machine')
+    parser.add_argument('--fast-math', dest='fastmath', type=fastmath_flags,
+                        default=(), metavar='FLAGS',
+                        help='comma separated fast-math flags of float '
+                        'instructions (%s)' % ', '.join(fastmath_names))
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='compile the functions of each program in this '
+                        'many worker processes (default: 1)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='do not use the object cache')
+    parser.add_argument('--cache-dir', default=None,
+                        help='object cache directory (default: %s)'
+                        % default_cache_dir)
+    parser.add_argument('--cache-size', type=int, default=64,
+                        help='object cache size in MB (default: 64)')
+    parser.add_argument('--cache-stats', action='store_true',
+                        help='print object cache statistics')
+    parser.add_argument('--emit-llvm', metavar='FILENAME', default=None,
+                        help='also write the LLVM IR to a file')
+    parser.add_argument('--timings', action='store_true',
+                        help='print the time taken by each phase')
+    opts = parser.parse_args()
+    if opts.emit_llvm and len(opts.filenames) > 1:
+        parser.error('--emit-llvm takes a single program')
+
+    cache = None
+    if not opts.no_cache:
+        cache = ObjectCache(opts.cache_dir, opts.cache_size * 1024 * 1024)
 
-    source = open(sys.argv[1]).read()
-    llvm_code = compile_llvm(source)
-    if not errors_reported():
-        run(llvm_code)
+    timings = {}
+    session = JITSession(opts.opt_level, cache, opts.host_cpu)
+    failed = False
+    for filename in opts.filenames:
+        clear_errors()
+        source = open(filename).read()
+        # Parallel compilation optimizes in the workers
+        parallel = opts.jobs > 1
+        module = compile_module(source, opts.opt_level if parallel else 0,
+                                opts.ssa, timings, opts.fastmath, opts.jobs)
+        if errors_reported():
+            failed = True
+            continue
+        if opts.emit_llvm:
+            with open(opts.emit_llvm, 'w') as f:
+                f.write(str(module))
+        program = session.add(module, timings, optimized=parallel)
+        session.run(program, timings)
+        session.remove(program)
+
+    sys.stdout.flush()
+    if opts.timings:
+        for phase, seconds in timings.items():
+            sys.stderr.write("%-10s %8.3f seconds\n" % (phase, seconds))
+    if opts.cache_stats and cache is not None:
+        sys.stderr.write("object cache %(directory)s: %(hits)d hits, "
+                         "%(misses)d misses, %(evictions)d evictions\n"
+                         % cache.stats())
+    if failed:
+        raise SystemExit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,222 @@
+# gone/sched.py
+'''
+Program Scheduler
+=================
+Runs many Gone programs in one process by interleaving them in the
+interpreter of gone/interp.py.  Every program gets its own Interpreter
+and is run a slice of instructions at a time (see
+Interpreter.resume()).  Programs take turns in round robin order, so
+long running programs do not hold up short ones, and each program can
+be limited in the number of instructions it may execute and in its call
+depth.  Output of each program is captured in memory.
+
+To run several programs concurrently use::
+
+    bash % python3 -m gone.sched Programs/fib.g Programs/mandel.g
+
+The scheduler can be driven synchronously with run() or from asyncio
+with run_async(), which yields to the event loop after every slice::
+
+    scheduler = Scheduler(slice=1000)
+    program = await scheduler.execute(functions, max_instructions=10**6)
+    print(program.result, program.output.getvalue())
+'''
+
+import asyncio
+import time
+from collections import deque
+
+from .interp import Interpreter, Output, link_functions
+
+
+class Program(object):
+    '''
+    A Gone program being run by a Scheduler.  It runs __init() and then
+    funcname(*args).  When it is finished, either result holds the value
+    returned or error the exception that stopped it.
+    '''
+
+    def __init__(self, functions, name="module", funcname='main', args=(),
+                 max_instructions=None, max_depth=None, output=None):
+        self.name = name
+        self.output = output or Output(capture=True)
+        self.interpreter = Interpreter(name, max_depth=max_depth,
+                                       output=self.output)
+        self.interpreter.register_functions(functions)
+        self.calls = deque([('__init', []), (funcname, list(args))])
+        self.max_instructions = max_instructions
+
+        # Number of instructions executed so far
+        self.instructions = 0
+
+        self.running = False
+        self.finished = False
+        self.result = None
+        self.error = None
+
+        # Future set when the program finishes (see Scheduler.execute())
+        self.waiter = None
+
+    def step(self, fuel):
+        '''
+        Run the program for at most fuel instructions.  Returns the
+        number of instructions executed.  A slice that ends in an error
+        counts in full.  Any exception, including one raised by an
+        extern function, only stops this program.
+        '''
+        interpreter = self.interpreter
+        used = budget = 0
+        try:
+            while used < fuel and not self.finished:
+                budget = fuel - used
+                if self.max_instructions is not None:
+                    budget = min(budget,
+                                 self.max_instructions - self.instructions)
+                    if budget <= 0:
+                        raise RuntimeError("Instruction limit of %d exceeded"
+                                           % self.max_instructions)
+                if not self.running:
+                    interpreter.start_function(*self.calls.popleft())
+                    self.running = True
+                left = interpreter.resume(budget)
+                ran = budget - (left or 0)
+                used += ran
+                self.instructions += ran
+                if left is not None:
+                    self.running = False
+                    if not self.calls:
+                        self.result = interpreter.retval
+                        self.finish()
+        except Exception as e:
+            used += budget
+            self.instructions += budget
+            self.error = e
+            self.finish()
+        return used
+
+    def finish(self):
+        self.finished = True
+        self.output.flush()
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(self)
+
+
+class Scheduler(object):
+    '''
+    Round robin scheduler of Programs.  Each turn runs a program for
+    slice instructions.  max_instructions and max_depth are the default
+    limits of the programs spawned.
+    '''
+
+    def __init__(self, slice=1000, max_instructions=None, max_depth=None):
+        self.slice = slice
+        self.max_instructions = max_instructions
+        self.max_depth = max_depth
+
+        # Programs waiting for their next turn
+        self.ready = deque()
+
+        # Task running run_async() for execute()
+        self.runner = None
+
+        # Statistics
+        self.finished = 0
+        self.instructions = 0
+        self.switches = 0
+
+    def spawn(self, functions, **options):
+        '''
+        Start a program made of linked functions (see link_functions()).
+        options are passed on to Program.
+        '''
+        options.setdefault('max_instructions', self.max_instructions)
+        options.setdefault('max_depth', self.max_depth)
+        program = Program(functions, **options)
+        self.ready.append(program)
+        return program
+
+    def run_next(self):
+        '''
+        Give the next ready program its turn
+        '''
+        program = self.ready.popleft()
+        self.instructions += program.step(self.slice)
+        self.switches += 1
+        if program.finished:
+            self.finished += 1
+        else:
+            self.ready.append(program)
+
+    def run(self):
+        '''
+        Run all programs to completion
+        '''
+        while self.ready:
+            self.run_next()
+
+    async def run_async(self):
+        '''
+        Run all programs to completion, letting other asyncio tasks run
+        between turns.  Programs spawned meanwhile are run as well.
+        '''
+        while self.ready:
+            self.run_next()
+            await asyncio.sleep(0)
+
+    async def execute(self, functions, **options):
+        '''
+        Spawn a program, run the scheduler in the background if it is
+        not running yet and wait for the program to finish.
+        '''
+        program = self.spawn(functions, **options)
+        program.waiter = asyncio.get_running_loop().create_future()
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.ensure_future(self.run_async())
+        return await program.waiter
+
+
+def main():
+    import argparse
+    import io
+    import sys
+    from contextlib import redirect_stdout
+    from .ircode import compile_ircode
+    from .errors import errors_reported
+
+    parser = argparse.ArgumentParser(prog='python3 -m gone.sched')
+    parser.add_argument('filenames', nargs='+', metavar='filename')
+    parser.add_argument('-s', '--slice', type=int, default=1000,
+                        help='instructions per turn (default: 1000)')
+    parser.add_argument('--max-instructions', type=int, default=None,
+                        help='maximum instructions each program may run')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='maximum depth of nested Gone calls')
+    opts = parser.parse_args()
+
+    scheduler = Scheduler(opts.slice, opts.max_instructions, opts.max_depth)
+    programs = []
+    for filename in opts.filenames:
+        with redirect_stdout(io.StringIO()):
+            functions = compile_ircode(open(filename).read())
+        if errors_reported():
+            raise SystemExit(1)
+        programs.append(scheduler.spawn(link_functions(functions),
+                                        name=filename))
+
+    start = time.perf_counter()
+    scheduler.run()
+    elapsed = time.perf_counter() - start
+
+    for program in programs:
+        print("==> %s <==" % program.name)
+        sys.stdout.write(program.output.getvalue())
+        if program.error is not None:
+            print("Runtime error: %s" % program.error)
+        else:
+            print("Program Returned: %d" % program.result)
+    sys.stderr.write("%d programs, %d instructions, %d turns in %.3f "
+                     "seconds\n" % (scheduler.finished, scheduler.instructions,
+                                    scheduler.switches, elapsed))
+
+if __name__ == '__main__':
+    main()
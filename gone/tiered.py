@@ -0,0 +1,281 @@
+# gone/tiered.py
+'''
+Tiered Execution
+================
+Starts a program in the interpreter of gone/interp.py and compiles the
+functions that turn out to be hot to native code with LLVM.  Short
+programs never pay for LLVM, long running ones get native speed where
+it matters.  To run a program with it use::
+
+    bash % python3 -m gone.interp --engine tiered someprogram.g
+
+TieredInterpreter counts the calls of every function that can be
+compiled and the loop back edges (backward jumps) taken inside it.
+When the count reaches the threshold, the function is compiled with
+GenerateSSABlocksLLVM into the MCJIT engine of gone/run.py, together with
+the functions it calls, and the call sites of the function are bound to
+the native code through ctypes.  A loop that is running when its
+function is compiled finishes in the interpreter; the next call is
+native.
+
+Only pure functions (see gone/purity.py) of int, float and bool values
+are compiled, since native code can not print through the interpreter
+output.  Global variables they read are fixed after __init and are
+compiled in as constants.  The native code is generated with
+GenerateCheckedLLVM, which divides like the interpreter and flags
+calls whose results would differ from the interpreter's (integers
+beyond 32 bits, division by zero); those calls, and calls with
+arguments that do not fit 32 bits, are run in the interpreter instead.
+
+Native code runs on the C stack and can not stop at the max_depth of
+the interpreter, so functions that recurse, or call functions that do,
+are not compiled.  The native call of a function nests at most as many
+calls as the longest call chain below it; when that could exceed
+max_depth the call is run in the interpreter, which raises the error
+at the right call.
+'''
+
+import ctypes
+import time
+import warnings
+from collections import Counter
+
+from .interp import Interpreter
+from .purity import called_from, pure_functions, function_instructions
+from .run import ctypes_types
+
+
+def call_depth(name, calls, depths):
+    '''
+    Return the number of nested calls of the longest call chain
+    starting with a call of name, which must not recurse.  calls maps
+    each function to the names of the functions it calls, depths
+    remembers the results.
+    '''
+    if name not in depths:
+        depths[name] = 1 + max([call_depth(callee, calls, depths)
+                                for callee in calls[name]] or [0])
+    return depths[name]
+
+
+class TieredInterpreter(Interpreter):
+    '''
+    Interpreter that compiles hot functions to native code.  threshold
+    is the number of calls and back edges after which a function is
+    compiled and opt_level the LLVM optimization level it is compiled
+    at.
+    '''
+
+    def __init__(self, name="module", threshold=1000, opt_level=2, **kwargs):
+        super(TieredInterpreter, self).__init__(name, **kwargs)
+        self.threshold = threshold
+        self.opt_level = opt_level
+        self.counts = Counter()
+
+        # Native functions by name, the names of functions that failed
+        # to compile with the reason and the time spent compiling
+        self.native = {}
+        self.failed = {}
+
+        # Positions of the int parameters of the native functions
+        self.int_parameters = {}
+        self.compile_time = 0.0
+
+        # MCJIT engine, created when the first function is compiled
+        self.engine = None
+
+        # Set by native code whose result differs from the interpreter's
+        # (see GenerateCheckedLLVM)
+        self.status = ctypes.c_int(0)
+
+    def register_functions(self, functionlist):
+        '''
+        Register linked functions.  The first element of each entry
+        must be the ircode.Function, which is needed to compile it.
+        '''
+        self.ircode = {func.name: func for func, code, nslots in functionlist}
+        calls = {name: {instr[1] for instr in function_instructions(func)
+                        if instr[0] == 'call_func'}
+                 for name, func in self.ircode.items()}
+        reached = {name: called_from(name, calls) for name in self.ircode}
+        recursive = {name for name in self.ircode if name in reached[name]}
+        self.compilable = {
+            name for name in pure_functions(self.ircode.values())
+            if self.compilable_types(self.ircode[name]) and
+            name not in recursive and not reached[name] & recursive}
+
+        # Calls nested by the native call of each compilable function
+        self.native_depth = {}
+        for name in self.compilable:
+            call_depth(name, calls, self.native_depth)
+        super(TieredInterpreter, self).register_functions(functionlist)
+
+        # Count the loop iterations of compilable functions
+        for name in self.compilable:
+            func = self.functions[name]
+            for pc, (handler, operands) in enumerate(func.code):
+                if func.opcodes[pc] == 'jump' and operands[0] <= pc:
+                    func.code[pc] = (self.run_jump_counted,
+                                     (operands[0], name))
+                    func.opcodes[pc] = 'jump_counted'
+
+    def compilable_types(self, func):
+        types = [func.return_type] + list(func.parameters)
+        return (all(typename in ctypes_types for typename in types) and
+                not any(instr[0].endswith('_string')
+                        for instr in function_instructions(func)))
+
+    def bind_calls(self, func):
+        '''
+        Calls of compilable functions are counted
+        '''
+        super(TieredInterpreter, self).bind_calls(func)
+        for pc, (handler, operands) in enumerate(func.code):
+            if (func.opcodes[pc].startswith('call_gone') and
+                    operands[0].name in self.compilable):
+                func.code[pc] = (self.run_call_counted, operands)
+                func.opcodes[pc] = 'call_counted'
+
+    def count(self, name):
+        self.counts[name] += 1
+        if (self.counts[name] >= self.threshold and
+                name not in self.native and name not in self.failed):
+            self.tier_up(name)
+
+    def tier_up(self, name):
+        '''
+        Compile a function to native code and bind its call sites to it
+        '''
+        start = time.perf_counter()
+        try:
+            self.compile(name)
+        except Exception as e:
+            self.failed[name] = str(e)
+            warnings.warn("Could not compile %s to native code, running it "
+                          "in the interpreter: %s" % (name, e), RuntimeWarning)
+        self.compile_time += time.perf_counter() - start
+        for func in self.functions.values():
+            for pc, (handler, operands) in enumerate(func.code):
+                if (func.opcodes[pc] == 'call_counted' and
+                        operands[0].name in self.native):
+                    func.code[pc] = (self.run_call_native, operands)
+                    func.opcodes[pc] = 'call_native'
+
+    def compile(self, name):
+        '''
+        Compile a function and the functions it calls that are not
+        compiled yet into a new module of the MCJIT engine
+        '''
+        import llvmlite.binding as llvm
+        from llvmlite.ir import Function, FunctionType, GlobalVariable
+        from llvmlite.ir import Constant
+        from .llvmgen import GenerateCheckedLLVM, GenerateSSABlocksLLVM
+        from .llvmgen import symbol_name, typemap
+        from .llvmgen import optimize
+        from .run import create_engine
+
+        # Functions to generate code for
+        names = [name]
+        for caller in names:
+            for instr in function_instructions(self.ircode[caller]):
+                if (instr[0] == 'call_func' and instr[1] not in names and
+                        instr[1] not in self.native):
+                    names.append(instr[1])
+
+        generator = GenerateCheckedLLVM('tier_' + name,
+                                        ctypes.addressof(self.status))
+        for callee in self.native:
+            func = self.ircode[callee]
+            generator.globals[callee] = Function(
+                generator.module,
+                FunctionType(typemap[func.return_type],
+                             [typemap[t] for t in func.parameters]),
+                name=symbol_name(callee))
+
+        # Globals read are constants once __init has run
+        for funcname in names:
+            for instr in function_instructions(self.ircode[funcname]):
+                if (instr[0].startswith('load_global_') and
+                        instr[1] not in generator.globals):
+                    vartype = typemap[instr[0].split('_')[-1]]
+                    var = GlobalVariable(generator.module, vartype,
+                                         name=instr[1])
+                    var.initializer = Constant(vartype,
+                                               self.globals[instr[1]])
+                    var.global_constant = True
+                    var.linkage = 'internal'
+                    generator.globals[instr[1]] = var
+
+        # Callees first (they nest fewer calls), so that calls find the
+        # functions they call
+        blockgen = GenerateSSABlocksLLVM(generator)
+        for funcname in sorted(names, key=self.native_depth.get):
+            blockgen.generate_function(self.ircode[funcname])
+
+        module = llvm.parse_assembly(str(generator.module))
+        module.verify()
+        optimize(module, self.opt_level)
+        if self.engine is None:
+            self.engine = create_engine(runtime=False)
+        self.engine.add_module(module)
+        self.engine.finalize_object()
+
+        for funcname in names:
+            func = self.ircode[funcname]
+            prototype = ctypes.CFUNCTYPE(
+                ctypes_types[func.return_type],
+                *[ctypes_types[t] for t in func.parameters])
+            self.native[funcname] = prototype(
+                self.engine.get_function_address(symbol_name(funcname)))
+            self.int_parameters[funcname] = [
+                n for n, typename in enumerate(func.parameters)
+                if typename == 'int']
+
+    def call_native(self, name, argvals):
+        '''
+        Call the native code of a function.  Returns None if the call
+        has to be run in the interpreter instead.
+        '''
+        if len(self.framestack) + self.native_depth[name] > self.max_depth:
+            return None
+        for n in self.int_parameters[name]:
+            if not -2 ** 31 <= argvals[n] < 2 ** 31:
+                return None
+        self.status.value = 0
+        result = self.native[name](*argvals)
+        if self.status.value:
+            return None
+        return result
+
+    def run_call_counted(self, func, target, *args):
+        frame = self.frame
+        argvals = [frame[name] for name in args]
+        self.count(func.name)
+        if func.name in self.native:
+            result = self.call_native(func.name, argvals)
+            if result is not None:
+                frame[target] = result
+                return
+        return self.call(func, argvals, target)
+
+    def run_call_native(self, func, target, *args):
+        frame = self.frame
+        argvals = [frame[name] for name in args]
+        result = self.call_native(func.name, argvals)
+        if result is None:
+            return self.call(func, argvals, target)
+        frame[target] = result
+
+    def run_jump_counted(self, target, name):
+        self.pc = target
+        self.count(name)
+
+    def tier_stats(self):
+        '''
+        Return a dict mapping each compilable function to its count and
+        whether it was compiled (True), failed to compile (the reason)
+        or still runs in the interpreter (False).
+        '''
+        return {name: (self.counts[name],
+                       name in self.native or self.failed.get(name, False))
+                for name in sorted(self.compilable)}
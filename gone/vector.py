@@ -0,0 +1,442 @@
+# gone/vector.py
+'''
+Vectorized Execution
+====================
+Runs one Gone function over NumPy arrays of arguments, computing all
+of its calls at once.  Every frame slot holds an array with one
+element (a lane) per call and every instruction is executed for many
+lanes by a single NumPy operation.  For example, in_mandelbrot() of
+Programs/mandel.g can be evaluated for every pixel of the picture in
+one call::
+
+    bash % python3 -m gone.vector Programs/mandel.g in_mandelbrot \\
+               -2.0:1.0:0.0375 1.5:-1.55:-0.075 1000
+
+Arguments given as start:stop:step are ranges.  The ranges of several
+arguments are combined into a grid (like numpy.meshgrid()), so the
+example computes the same 80x41 picture as mandel().
+
+The code is the same linked code run by gone.interp.  Each lane has its
+own program counter.  Lanes go their own way at a cbranch, so each
+step runs the instruction at the lowest program counter of the active
+lanes, for just the lanes that are there (a mask).  Lanes that finished
+a loop or took the other branch wait until the lanes behind catch up,
+which keeps them together for as long as possible.  A lane is finished
+when it returns.
+
+Only functions that compute a result are supported: printing and
+assigning global variables raise a RuntimeError.  Calls of Gone
+functions are vectorized over the lanes making the call.  Extern
+functions use the NumPy function of the same name if there is one and
+are called once per lane otherwise.  Values are NumPy int64 and float64
+numbers, so unlike the interpreter, integers can overflow.
+'''
+
+import operator
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import interp
+
+# NumPy element types of the Gone types
+dtypes = {
+    'int': 'int64',
+    'float': 'float64',
+    'bool': 'bool',
+    'string': 'object',
+}
+
+
+def checked_division(op, message):
+    '''
+    Make a division raise ZeroDivisionError, as in the interpreter,
+    instead of NumPy's warning and a result of 0 or inf
+    '''
+    def divide(left, right):
+        if np.any(np.asarray(right) == 0):
+            raise ZeroDivisionError(message)
+        return op(left, right)
+    return divide
+
+
+# Functions of the binary and unary opcodes.  Opcodes are looked up
+# without their type suffix except where the semantics of the types
+# differ (division).
+binary_ops = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'mul': operator.mul,
+    'div_int': checked_division(operator.floordiv,
+                                'integer division or modulo by zero'),
+    'div_float': checked_division(operator.truediv, 'float division by zero'),
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+    'eq': operator.eq,
+    'ne': operator.ne,
+    'and': operator.and_,
+    'or': operator.or_,
+}
+
+unary_ops = {
+    'uadd': operator.pos,
+    'usub': operator.neg,
+    'not': operator.invert,
+}
+
+
+class VectorFrame(object):
+    '''
+    State of one vectorized call: the slot arrays, the arguments, the
+    program counter and the result of each lane and which lanes are
+    still running.
+    '''
+
+    def __init__(self, args, nslots, size):
+        self.slots = [None] * nslots
+        self.args = args
+        self.size = size
+        self.pcs = np.zeros(size, dtype='intp')
+        self.active = np.ones(size, dtype='bool')
+        self.result = None
+
+        # Lanes running the current instruction, None for all lanes
+        self.mask = None
+
+    def get(self, slot):
+        if self.mask is None:
+            return self.slots[slot]
+        return self.slots[slot][self.mask]
+
+    def put(self, slot, values):
+        '''
+        Set the lanes in the mask of a slot.  values is an array with
+        an element for each of those lanes or a single value.  Arrays
+        may be kept as they are, so they must not be used elsewhere.
+        '''
+        if self.mask is None:
+            if np.shape(values) != (self.size,):
+                values = np.array(np.broadcast_to(values, self.size))
+            self.slots[slot] = values
+            return
+        if self.slots[slot] is None:
+            self.slots[slot] = np.zeros(self.size,
+                                        dtype=np.asarray(values).dtype)
+        self.slots[slot][self.mask] = values
+
+    def finish(self, values):
+        '''
+        Return values from the lanes in the mask
+        '''
+        if self.result is None:
+            self.result = np.zeros(self.size,
+                                   dtype=np.asarray(values).dtype)
+        if self.mask is None:
+            self.result[:] = values
+            self.active[:] = False
+        else:
+            self.result[self.mask] = values
+            self.active[self.mask] = False
+
+
+class VectorInterpreter(object):
+    '''
+    Runs Gone functions over arrays of arguments.  Like
+    gone.interp.Interpreter, it takes linked functions and decodes
+    every instruction into a (handler, operands) pair up front.
+    Handlers work on self.frame, the VectorFrame of the current call,
+    for the lanes in its mask.  Those that set the program counters
+    themselves return True.
+
+    Global variables are read from self.globals, which is typically
+    filled by running __init in a scalar interpreter first.
+    '''
+
+    def __init__(self, globals=None):
+        if np is None:
+            raise RuntimeError("Vectorized execution requires numpy")
+        self.globals = dict(globals or {})
+        self.functions = {}
+        self.frame = None
+
+    def register_functions(self, functionlist):
+        for func, code, nslots in functionlist:
+            self.functions[func.name] = interp.DecodedFunction(
+                func.name, self.decode(code), nslots)
+
+    def decode(self, code):
+        '''
+        Decode linked code.  Operators are found in the binary_ops and
+        unary_ops tables.  Instructions that cannot be vectorized raise
+        a RuntimeError when they run.
+        '''
+        decoded = []
+        for instr in code:
+            opcode, operands = instr[0], instr[1:]
+            parts = opcode.split('_')
+            kind = parts[0]
+            op = binary_ops.get('_'.join(parts[:2]), binary_ops.get(kind))
+            if hasattr(self, 'run_' + opcode):
+                decoded.append((getattr(self, 'run_' + opcode), operands))
+            elif kind == 'cbranch':
+                handler = self.run_cbranch_compare
+                if opcode.endswith('_const'):
+                    handler = self.run_cbranch_compare_const
+                decoded.append((handler, (binary_ops[parts[1]],) + operands))
+            elif op is not None and opcode.endswith('_const'):
+                decoded.append((self.run_binary_const, (op,) + operands))
+            elif op is not None:
+                decoded.append((self.run_binary, (op,) + operands))
+            elif kind in unary_ops:
+                decoded.append((self.run_unary, (unary_ops[kind],) + operands))
+            else:
+                decoded.append((self.run_unsupported, (opcode,)))
+        decoded.append((self.run_return_void, ()))
+        return decoded
+
+    def execute_function(self, funcname, args):
+        '''
+        Call a Gone function for each element of its arguments, which
+        are broadcast against each other.  Returns an array of results
+        in the shape of the broadcast arguments.
+        '''
+        args = np.broadcast_arrays(*[np.asarray(arg) for arg in args])
+        shape = args[0].shape if args else ()
+        flat = [np.ravel(arg) for arg in args]
+        size = flat[0].size if flat else 1
+        return self.call(self.functions[funcname], flat, size).reshape(shape)
+
+    def call(self, func, args, size):
+        '''
+        Run a DecodedFunction to completion on size lanes and return
+        the array of results.
+        '''
+        saved = self.frame
+        frame = self.frame = VectorFrame(args, func.nslots, size)
+        code = func.code
+        pcs = frame.pcs
+        active = frame.active
+        try:
+            while active.any():
+                # Run the instruction at the lowest program counter
+                pc = pcs[active].min()
+                mask = active & (pcs == pc)
+                frame.mask = None if mask.all() else mask
+                handler, operands = code[pc]
+                if not handler(*operands):
+                    pcs[mask] = pc + 1
+        finally:
+            self.frame = saved
+        return frame.result
+
+    # ----------------------------------------------------------------------
+    # Opcode implementation
+    # ----------------------------------------------------------------------
+
+    def run_literal_int(self, value, target):
+        self.frame.put(target, value)
+
+    run_literal_float = run_literal_int
+    run_literal_string = run_literal_int
+    run_literal_bool = run_literal_int
+
+    def run_alloc_int(self, name):
+        self.frame.put(name, np.zeros((), dtype=dtypes['int']))
+
+    def run_alloc_float(self, name):
+        self.frame.put(name, np.zeros((), dtype=dtypes['float']))
+
+    def run_alloc_string(self, name):
+        self.frame.put(name, np.full((), '', dtype=dtypes['string']))
+
+    def run_alloc_bool(self, name):
+        self.frame.put(name, np.zeros((), dtype=dtypes['bool']))
+
+    def run_load_local_int(self, source, target):
+        self.frame.put(target, self.frame.get(source).copy())
+
+    run_load_local_float = run_load_local_int
+    run_load_local_string = run_load_local_int
+    run_load_local_bool = run_load_local_int
+    run_store_local_int = run_load_local_int
+    run_store_local_float = run_load_local_int
+    run_store_local_string = run_load_local_int
+    run_store_local_bool = run_load_local_int
+
+    def run_load_global_int(self, name, target):
+        if name not in self.globals:
+            raise RuntimeError("Global %s is not defined" % name)
+        self.frame.put(target, self.globals[name])
+
+    run_load_global_float = run_load_global_int
+    run_load_global_string = run_load_global_int
+    run_load_global_bool = run_load_global_int
+
+    def run_parm_int(self, name, num):
+        args = self.frame.args[num]
+        if self.frame.mask is None:
+            args = args.copy()
+        else:
+            args = args[self.frame.mask]
+        self.frame.put(name, args)
+
+    run_parm_float = run_parm_int
+    run_parm_string = run_parm_int
+    run_parm_bool = run_parm_int
+
+    def run_binary(self, op, left, right, target):
+        self.frame.put(target, op(self.frame.get(left),
+                                  self.frame.get(right)))
+
+    def run_binary_const(self, op, left, value, target):
+        self.frame.put(target, op(self.frame.get(left), value))
+
+    def run_unary(self, op, source, target):
+        self.frame.put(target, op(self.frame.get(source)))
+
+    def run_extern_func(self, name, *types):
+        pass
+
+    def run_call_func(self, funcname, *args):
+        '''
+        Call a function for the lanes in the mask.  Gone functions are
+        called once for all of them.
+        '''
+        frame = self.frame
+        argvals = [frame.get(name) for name in args[:-1]]
+        if funcname in self.functions:
+            size = int(frame.mask.sum()) if frame.mask is not None \
+                else frame.size
+            result = self.call(self.functions[funcname], argvals, size)
+        else:
+            func = getattr(np, funcname, None)
+            if not isinstance(func, np.ufunc):
+                func = np.vectorize(self.extern(funcname))
+            result = func(*argvals)
+        frame.put(args[-1], result)
+
+    def extern(self, name):
+        if callable(self.globals.get(name)):
+            return self.globals[name]
+        return interp.find_extern(name)
+
+    def run_return_int(self, source):
+        self.frame.finish(self.frame.get(source))
+        return True
+
+    run_return_float = run_return_int
+    run_return_string = run_return_int
+    run_return_bool = run_return_int
+
+    def run_return_void(self):
+        self.frame.finish(np.zeros((), dtype='object'))
+        return True
+
+    def run_jump(self, target):
+        self.branch(target)
+        return True
+
+    def run_cbranch(self, testvar, true_target, false_target):
+        self.branch(np.where(self.frame.get(testvar), true_target,
+                             false_target))
+        return True
+
+    def run_cbranch_compare(self, op, left, right, true_target, false_target):
+        self.branch(np.where(op(self.frame.get(left), self.frame.get(right)),
+                             true_target, false_target))
+        return True
+
+    def run_cbranch_compare_const(self, op, left, value, true_target,
+                                  false_target):
+        self.branch(np.where(op(self.frame.get(left), value),
+                             true_target, false_target))
+        return True
+
+    def branch(self, targets):
+        '''
+        Set the program counters of the lanes in the mask
+        '''
+        if self.frame.mask is None:
+            self.frame.pcs[:] = targets
+        else:
+            self.frame.pcs[self.frame.mask] = targets
+
+    def run_unsupported(self, opcode):
+        raise RuntimeError("%s cannot be vectorized" % opcode)
+
+
+def load_program(functions):
+    '''
+    Create a VectorInterpreter for a list of ircode.Function objects.
+    Global variables are initialized by running __init in the
+    interpreter of gone.interp.
+    '''
+    scalar = interp.create_interpreter(functions)
+    scalar.execute_function('__init', [])
+    vector = VectorInterpreter(scalar.globals)
+    vector.register_functions(interp.link_functions(functions))
+    return vector
+
+
+def parse_argument(text):
+    '''
+    Convert a command line argument to a number or bool or, for
+    start:stop:step, a range of numbers.
+    '''
+    def number(value):
+        if value in ('true', 'false'):
+            return value == 'true'
+        return float(value) if '.' in value or 'e' in value else int(value)
+
+    if ':' in text:
+        start, stop, step = text.split(':')
+        return np.arange(number(start), number(stop), number(step))
+    return number(text)
+
+
+def main():
+    import argparse
+    import sys
+    import time
+    from .ircode import compile_ircode
+    from .errors import errors_reported
+
+    parser = argparse.ArgumentParser(prog='python3 -m gone.vector')
+    parser.add_argument('filename')
+    parser.add_argument('funcname')
+    parser.add_argument('args', nargs=argparse.REMAINDER, metavar='arg',
+                        help='number or start:stop:step range')
+    opts = parser.parse_args()
+
+    functions = compile_ircode(open(opts.filename).read())
+    if errors_reported():
+        raise SystemExit(1)
+
+    # Arguments given as ranges make up a grid
+    args = [parse_argument(arg) for arg in opts.args]
+    ranges = [n for n, arg in enumerate(args) if np.ndim(arg)]
+    for n, grid in zip(ranges, np.meshgrid(*[args[n] for n in ranges])):
+        args[n] = grid
+
+    try:
+        vector = load_program(functions)
+        start = time.perf_counter()
+        result = vector.execute_function(opts.funcname, args)
+        elapsed = time.perf_counter() - start
+    except (RuntimeError, ZeroDivisionError) as e:
+        sys.stderr.write("Runtime error: %s\n" % e)
+        raise SystemExit(1)
+
+    for row in np.atleast_2d(result):
+        if row.dtype == np.bool_:
+            print(''.join('*' if value else '.' for value in row))
+        else:
+            print(' '.join(str(value) for value in row))
+    sys.stderr.write("%d calls in %.3f seconds\n" % (result.size, elapsed))
+
+if __name__ == '__main__':
+    main()
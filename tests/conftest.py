@@ -0,0 +1,43 @@
+import contextlib
+import io
+import os
+import subprocess
+
+import pytest
+
+from gone.errors import clear_errors
+from gone.ircode import compile_ircode
+
+
+@pytest.fixture
+def compile_source():
+    '''
+    Compile Gone source to a list of ircode.Function objects, hiding
+    the compiler's debugging output
+    '''
+    def compile_source(source):
+        clear_errors()
+        with contextlib.redirect_stdout(io.StringIO()):
+            return compile_ircode(source)
+    return compile_source
+
+
+@pytest.fixture(scope='session')
+def runtime():
+    '''
+    Build gone/gonert.so, the runtime the JIT loads, if it is missing.
+    Tests of the JIT are skipped without llvmlite or a C compiler.
+    '''
+    pytest.importorskip('llvmlite')
+    from gone import run
+    from gone.compile import c_compiler
+
+    path = os.path.join(run._path, 'gonert.so')
+    if not os.path.exists(path):
+        try:
+            subprocess.check_output(
+                [c_compiler(), '-shared', '-fPIC', 'gonert.c', '-o', path],
+                cwd=run._path, stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError) as e:
+            pytest.skip("gonert.so can not be built: %s" % e)
+    return path
@@ -0,0 +1,29 @@
+import pytest
+
+from gone import interp
+from gone.purity import function_instructions
+
+
+@pytest.mark.parametrize('x, y', [(7, 2), (-7, 2), (7, -2), (-7, -2)])
+def test_folded_division_matches_runtime(compile_source, x, y):
+    functions = compile_source('''
+        const c = %d / %d;
+        func main() int {
+            var x int = %d;
+            var y int = %d;
+            print c;
+            print x / y;
+            return 0;
+        }
+    ''' % (x, y, x, y))
+    output = interp.Output(capture=True)
+    interpreter = interp.create_interpreter(functions, output=output)
+    interpreter.execute_function('__init', [])
+    interpreter.execute_function('main', [])
+    folded, unfolded = output.getvalue().split()
+    assert folded == unfolded
+
+    # Only divisions that round the same in every backend are folded
+    init = [func for func in functions if func.name == '__init'][0]
+    assert any(instr[0] == 'div_int'
+               for instr in function_instructions(init)) == (x < 0 or y < 0)
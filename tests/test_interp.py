@@ -0,0 +1,194 @@
+import contextlib
+import gc
+import io
+from collections import Counter
+
+import pytest
+
+from gone import interp
+
+
+def run_main(functions, **options):
+    output = interp.Output(capture=True)
+    interpreter = interp.create_interpreter(functions, output=output,
+                                            **options)
+    interpreter.execute_function('main', [])
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'fuse': False}, {'engine': 'python'},
+])
+def test_redefined_forwarded_local(compile_source, options):
+    # After store_forward, the literal writes a directly; a is written
+    # again before it is read, so the literal must not be forwarded
+    functions = compile_source('''
+        func main() int {
+            var b int = 5;
+            var c int = 7;
+            var a int = 1;
+            a = b + c;
+            print 2 - a;
+            return 0;
+        }
+    ''')
+    assert run_main(functions, **options) == '-10\n'
+
+
+def test_superinstructions(compile_source):
+    functions = compile_source('''
+        func main() int {
+            var i int = 0;
+            var total int = 0;
+            while i < 10 {
+                if i > 4 {
+                    total = total + i * 2;
+                } else {
+                    total = total - 1;
+                }
+                i = i + 1;
+            }
+            print total;
+            return 0;
+        }
+    ''')
+    fusions = Counter()
+    fused = {func.name: code for func, code, nslots in
+             interp.link_functions(functions, fusions=fusions)}
+    plain = {func.name: code for func, code, nslots in
+             interp.link_functions(functions, fuse=False)}
+    assert len(fused['main']) < len(plain['main'])
+    assert fusions['compare_branch'] and fusions['literal_operand']
+    assert run_main(functions) == run_main(functions, fuse=False) == '65\n'
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'engine': 'python'}, {'engine': 'python', 'memoize': True},
+])
+def test_max_depth(compile_source, options):
+    functions = compile_source('''
+        func depth(n int) int {
+            if n == 0 {
+                return 0;
+            }
+            return depth(n - 1) + 1;
+        }
+        func main() int {
+            print depth(8);
+            return 0;
+        }
+    ''')
+    assert run_main(functions, max_depth=10, **options) == '8\n'
+    with pytest.raises(RuntimeError, match='Maximum call depth of 9'):
+        run_main(functions, max_depth=9, **options)
+
+
+def test_batch_job_errors_are_kept_per_job(compile_source):
+    program = interp.compact_functions(interp.link_functions(compile_source('''
+        var calls int = 0;
+        func divide(a int, b int) int {
+            calls = calls + 1;
+            print calls;
+            return a / b;
+        }
+    ''')))
+    jobs = [(0, 'divide', (7, 2)), (0, 'divide', (1, 0)),
+            (0, 'divide', (9, 3))]
+    results = interp.run_batch([program], jobs, workers=1)
+    assert results[0] == (3, '1\n', None)
+    assert results[1][0] is None
+    assert results[1][2].startswith('ZeroDivisionError')
+    assert results[2] == (3, '1\n', None)
+
+
+PRINT_42 = '''
+    func main() int {
+        print 42;
+        return 0;
+    }
+'''
+
+
+def test_output_is_flushed_when_collected(compile_source, capsys):
+    functions = compile_source(PRINT_42)
+
+    def run():
+        interpreter = interp.create_interpreter(functions)
+        interpreter.execute_function('main', [])
+
+    run()
+    gc.collect()
+    assert capsys.readouterr().out == '42\n'
+
+
+def test_output_to_text_stdout(compile_source):
+    functions = compile_source(PRINT_42)
+    with contextlib.redirect_stdout(io.StringIO()) as stdout:
+        interpreter = interp.create_interpreter(functions)
+        interpreter.execute_function('main', [])
+        interpreter.output.flush()
+    assert stdout.getvalue() == '42\n'
+
+
+def test_profile_inclusive_time_is_sum_of_exclusive(compile_source):
+    output = interp.Output(capture=True)
+    interpreter = interp.create_interpreter(compile_source('''
+        func fib(n int) int {
+            if n < 2 {
+                return n;
+            }
+            return fib(n - 1) + fib(n - 2);
+        }
+        func square(n int) int {
+            return n * n;
+        }
+        func main() int {
+            print fib(12) + square(3);
+            return 0;
+        }
+    '''), profile=True, output=output)
+    interpreter.execute_function('main', [])
+    assert output.getvalue() == '153\n'
+    functions = interpreter.profile.functions()
+    main, fib, square = (functions[name] for name in ('main', 'fib', 'square'))
+    assert fib['calls'] == 465 and fib['primitive_calls'] == 1
+    assert fib['inclusive'] == pytest.approx(fib['exclusive'])
+    assert main['inclusive'] == pytest.approx(
+        main['exclusive'] + fib['inclusive'] + square['inclusive'])
+
+
+def test_python_engine_recursion_limit(compile_source):
+    functions = compile_source('''
+        func depth(n int) int {
+            if n == 0 {
+                return 0;
+            }
+            return depth(n - 1) + 1;
+        }
+        func main() int {
+            print depth(100000);
+            return 0;
+        }
+    ''')
+    assert run_main(functions) == '100000\n'
+    with pytest.raises(RuntimeError, match='Maximum call depth of .* '
+                       'exceeded calling depth'):
+        run_main(functions, engine='python')
+
+
+@pytest.mark.parametrize('options', [{}, {'engine': 'python'}])
+def test_extern_functions(compile_source, options):
+    functions = compile_source('''
+        extern func sqrt(x float) float;
+        extern func putchar(c int) int;
+        func main() int {
+            print sqrt(2.25);
+            return putchar(10);
+        }
+    ''')
+    output = interp.Output(capture=True)
+    interpreter = interp.create_interpreter(functions, output=output,
+                                            **options)
+    interpreter.execute_function('__init', [])
+    assert interpreter.execute_function('main', []) == 10
+    assert output.getvalue() == '1.5\n\n'
@@ -0,0 +1,75 @@
+import contextlib
+import io
+
+import pytest
+
+pytest.importorskip('llvmlite')
+
+from gone import llvmgen  # noqa: E402
+from gone.errors import clear_errors, errors_reported  # noqa: E402
+
+
+def test_parallel_compile_reports_errors():
+    clear_errors()
+    with contextlib.redirect_stdout(io.StringIO()):
+        llvm_code = llvmgen.compile_llvm('func main() int { return x; }',
+                                         jobs=2)
+    assert errors_reported()
+    assert 'define' not in llvm_code
+
+
+def test_ssa_code_computes_what_the_interpreter_does(runtime,
+                                                     compile_source):
+    from gone import interp, run
+
+    source = '''
+        func collatz(n int) int {
+            var steps int = 0;
+            while n != 1 {
+                if n / 2 * 2 == n {
+                    n = n / 2;
+                } else {
+                    n = 3 * n + 1;
+                }
+                steps = steps + 1;
+            }
+            return steps;
+        }
+        func series(n int, x float) float {
+            var total float = 0.0;
+            var term float = 1.0;
+            var i int = 0;
+            while i < n {
+                total = total + term;
+                term = term * x;
+                i = i + 1;
+            }
+            return total;
+        }
+    '''
+    interpreter = interp.create_interpreter(compile_source(source))
+    stack = run.load(source, opt_level=0, ssa=False)
+    ssa = run.load(source, opt_level=0, ssa=True)
+    for n in (1, 6, 27, 97):
+        expected = interpreter.execute_function('collatz', [n])
+        assert stack.collatz(n) == ssa.collatz(n) == expected
+        expected = interpreter.execute_function('series', [n, 0.5])
+        assert stack.series(n, 0.5) == ssa.series(n, 0.5) == expected
+    stack.close()
+    ssa.close()
+
+
+def test_fast_math_flags():
+    source = '''
+        func axpy(a float, x float, y float) float {
+            return a * x + y;
+        }
+    '''
+    clear_errors()
+    flags = llvmgen.fastmath_flags('reassoc,contract')
+    llvm_code = llvmgen.compile_llvm(source, fastmath=flags)
+    assert 'fmul reassoc contract double' in llvm_code
+    assert 'fadd reassoc contract double' in llvm_code
+    assert 'reassoc' not in llvmgen.compile_llvm(source)
+    with pytest.raises(ValueError):
+        llvmgen.fastmath_flags('fast,slow')
@@ -0,0 +1,113 @@
+import pytest
+
+pytest.importorskip('llvmlite')
+
+from gone import run  # noqa: E402
+from gone.llvmgen import compile_llvm  # noqa: E402
+
+SQUARES = '''
+    var offset int = 3;
+    func square(n int) int {
+        return n * n + offset;
+    }
+    func scale(x float, factor float) float {
+        return x * factor;
+    }
+    func main() int {
+        return square(4);
+    }
+'''
+
+CUBES = '''
+    func square(n int) int {
+        return n * n * n;
+    }
+    func main() int {
+        return square(2);
+    }
+'''
+
+
+@pytest.fixture
+def session(runtime):
+    session = run.JITSession()
+    yield session
+    session.close()
+
+
+def test_object_cache(runtime, tmp_path):
+    llvm_code = compile_llvm(SQUARES)
+    cache = run.ObjectCache(str(tmp_path))
+    run.run(llvm_code, cache=cache)
+    assert cache.stats()['misses'] == 1
+    assert len(list(tmp_path.glob('*.o'))) == 1
+
+    cache = run.ObjectCache(str(tmp_path))
+    run.run(llvm_code, cache=cache)
+    assert cache.stats()['hits'] == 1
+
+    # An entry bigger than the cache is evicted right away
+    cache = run.ObjectCache(str(tmp_path), max_size=0)
+    run.run(llvm_code, opt_level=2, cache=cache)
+    assert cache.stats()['evictions'] == 2
+    assert not list(tmp_path.glob('*.o'))
+
+
+def test_session_programs(session):
+    squares = session.add(compile_llvm(SQUARES))
+    cubes = session.add(compile_llvm(CUBES))
+    assert squares.prefix != cubes.prefix
+    assert session.run(squares) == 19
+    assert session.run(cubes) == 8
+
+    # Adding the same code again reuses the loaded program
+    assert session.add(compile_llvm(CUBES)) is cubes
+    session.remove(cubes)
+    assert session.run(cubes) == 8
+    session.remove(cubes)
+    assert session.stats()['programs'] == 1
+    assert session.run(squares) == 19
+
+
+def test_load(runtime):
+    funcs = run.load(SQUARES)
+    assert funcs.square(5) == 28
+    assert funcs.scale(1.5, 4.0) == 6.0
+    assert funcs.main() == 19
+    assert 'square(int) int' in repr(funcs)
+    funcs.close()
+
+
+def test_array_kernel(runtime):
+    np = pytest.importorskip('numpy')
+    funcs = run.load(SQUARES, arrays=['square', 'scale'])
+    xs = np.arange(10, dtype='int32')
+    assert list(funcs.square.array(xs)) == [x * x + 3 for x in range(10)]
+    grid = funcs.scale.array(np.linspace(0.0, 1.0, 5), [[1.0], [2.0]])
+    assert grid.shape == (2, 5)
+    assert grid[1, 4] == 2.0
+    out = np.empty(10, dtype='int32')
+    assert funcs.square.array(xs, out=out) is out
+    with pytest.raises(ValueError):
+        funcs.square.array(xs, out=np.empty(10))
+    funcs.close()
+
+
+def test_host_cpu_and_fast_math(runtime):
+    source = '''
+        func total(n int) float {
+            var s float = 0.0;
+            var i int = 0;
+            while i < n {
+                s = s + 0.5;
+                i = i + 1;
+            }
+            return s;
+        }
+    '''
+    generic = run.load(source)
+    native = run.load(source, opt_level=3, host_cpu=True,
+                      fastmath=('reassoc', 'contract'))
+    assert generic.total(1000) == native.total(1000) == 500.0
+    generic.close()
+    native.close()
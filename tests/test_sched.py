@@ -0,0 +1,34 @@
+import asyncio
+
+from gone.interp import link_functions
+from gone.sched import Scheduler
+
+
+def test_failing_program_does_not_stop_others(compile_source):
+    failing = link_functions(compile_source('''
+        func main() int {
+            var zero int = 0;
+            return 1 / zero;
+        }
+    '''))
+    healthy = link_functions(compile_source('''
+        func main() int {
+            var i int = 0;
+            while i < 1000 {
+                i = i + 1;
+            }
+            print i;
+            return 0;
+        }
+    '''))
+
+    async def run_both():
+        scheduler = Scheduler(slice=10)
+        return await asyncio.wait_for(asyncio.gather(
+            scheduler.execute(failing), scheduler.execute(healthy)), 10)
+
+    bad, good = asyncio.run(run_both())
+    assert isinstance(bad.error, ZeroDivisionError)
+    assert good.error is None
+    assert good.result == 0
+    assert good.output.getvalue() == '1000\n'
@@ -0,0 +1,113 @@
+import pytest
+
+from gone import interp
+
+pytest.importorskip('llvmlite')
+
+# A function that fails to compile must fail the test, not fall back to
+# the interpreter
+pytestmark = pytest.mark.filterwarnings('error::RuntimeWarning')
+
+
+def run_main(functions, **options):
+    output = interp.Output(capture=True)
+    interpreter = interp.create_interpreter(functions, output=output,
+                                            **options)
+    interpreter.execute_function('__init', [])
+    interpreter.execute_function('main', [])
+    return output.getvalue(), interpreter
+
+
+def compare(functions):
+    expected, _ = run_main(functions)
+    result, tiered = run_main(functions, engine='tiered', threshold=10)
+    assert result == expected
+    return tiered
+
+
+def test_negative_division(compile_source):
+    tiered = compare(compile_source('''
+        func h(n int, d int) int {
+            return (0 - n) / d;
+        }
+        func main() int {
+            var i int = 0;
+            var s int = 0;
+            while i < 100 {
+                s = s + h(i, 3) + h(i, 0 - 4) + h(0 - i, 0 - 7);
+                i = i + 1;
+            }
+            print s;
+            return 0;
+        }
+    '''))
+    assert 'h' in tiered.native
+
+
+def test_overflow_runs_in_interpreter(compile_source):
+    tiered = compare(compile_source('''
+        func cube(n int) int {
+            return n * n * n;
+        }
+        func main() int {
+            var i int = 0;
+            while i < 100 {
+                print cube(i * 100);
+                i = i + 1;
+            }
+            print cube(2000000);
+            return 0;
+        }
+    '''))
+    assert 'cube' in tiered.native
+
+
+def test_division_by_zero_raises(compile_source):
+    functions = compile_source('''
+        func quotient(a int, b int) int {
+            return a / b;
+        }
+        func main() int {
+            var i int = 0;
+            while i < 100 {
+                print quotient(100, 10 - i);
+                i = i + 1;
+            }
+            return 0;
+        }
+    ''')
+    with pytest.raises(ZeroDivisionError):
+        run_main(functions, engine='tiered', threshold=5)
+
+
+def test_max_depth(compile_source):
+    functions = compile_source('''
+        func inner(n int) int {
+            return n + 1;
+        }
+        func outer(n int) int {
+            return inner(n) * 2;
+        }
+        func depth(n int) int {
+            if n == 0 {
+                return 0;
+            }
+            return depth(n - 1) + 1;
+        }
+        func main() int {
+            var i int = 0;
+            while i < 100 {
+                print outer(i);
+                i = i + 1;
+            }
+            print depth(200);
+            return 0;
+        }
+    ''')
+    tiered = compare(functions)
+    assert 'outer' in tiered.native
+    assert 'depth' not in tiered.compilable
+    for max_depth in (2, 100):
+        with pytest.raises(RuntimeError, match='Maximum call depth'):
+            run_main(functions, engine='tiered', threshold=10,
+                     max_depth=max_depth)
@@ -0,0 +1,26 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from gone import vector  # noqa: E402
+
+
+def test_division_by_zero_raises(compile_source):
+    program = vector.load_program(compile_source('''
+        func quotient(a int, b int) int {
+            return a / b;
+        }
+    '''))
+    with pytest.raises(ZeroDivisionError):
+        program.execute_function('quotient', [10, np.array([2, 1, 0])])
+
+
+def test_extern_functions(compile_source):
+    program = vector.load_program(compile_source('''
+        extern func sqrt(x float) float;
+        func norm(x float, y float) float {
+            return sqrt(x * x + y * y);
+        }
+    '''))
+    result = program.execute_function('norm', [np.array([3.0, 5.0]), 4.0])
+    assert list(result) == [5.0, 41 ** 0.5]